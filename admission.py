@@ -0,0 +1,221 @@
+"""
+查詢的准入控制 (admission control)
+
+每個 `/products` 查詢先估計成本 (約等於在這個資料庫上花費的毫秒數)，
+再依序檢查：
+1. 成本超過 MAX_COST 的查詢直接拒絕 (400)，請客戶端縮小範圍
+2. 每個客戶端有自己的 token bucket，成本用完就回傳 429 與 Retry-After
+3. 同時執行的查詢數有上限，超過時排隊，佇列滿了或等太久也回傳 429
+
+被拒絕的請求不會碰到資料庫，統計數字可以從 `/api/v1/admission` 查看。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+
+# 每個客戶端每秒可以使用的成本與最多可以累積的成本
+CLIENT_RATE = 20.0
+CLIENT_BURST = 100.0
+
+# 單一查詢的成本上限
+MAX_COST = CLIENT_BURST
+
+# 同時執行的查詢數、排隊的請求數上限，以及最多排隊幾秒
+MAX_CONCURRENT_QUERIES = 4
+MAX_QUEUE = 32
+QUEUE_TIMEOUT = 1.0
+
+# 最多記錄幾個客戶端的 token bucket，超過時移除最久沒有使用的
+MAX_CLIENTS = 10000
+
+# 用來辨識客戶端的 header (服務放在 cloudflared tunnel 後面，連線來源都是本機)
+CLIENT_HEADERS = ("cf-connecting-ip", "x-forwarded-for")
+
+# 只有連線來自這些位址 (cloudflared 等反向代理) 時才採用 CLIENT_HEADERS，
+# 直接連到服務的客戶端可以任意填寫這些 header，一律以連線 IP 辨識
+TRUSTED_PROXIES = frozenset(
+    ip.strip() for ip in os.environ.get("PRICESCOUT_TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if ip.strip()
+)
+
+
+def estimate_cost(
+    category1: Optional[str] = None,
+    category2: Optional[str] = None,
+    category3: Optional[str] = None,
+    channel: Optional[str] = None,
+    query: Optional[str] = None,
+    page: int = 1,
+    limit: int = 10,
+    store: Optional[str] = None,
+    snapshot: bool = False,
+) -> float:
+    """
+    依 benchmark.py 量測的 SQL 查詢時間估計成本：
+    每個關鍵字都是一次 LIKE 掃描，回傳的每筆商品約 0.02ms，offset 略過的每筆約 0.005ms。
+    使用商品快照時成本約為十分之一。
+    """
+    cost = 1.0
+    if category1 or category2 or category3:
+        cost += 1.0
+    if channel:
+        cost += 0.2
+    if query:
+        cost += 1.0 + 0.2 * len(query.split())
+    if store:
+        cost += 0.5
+    cost += 0.02 * limit + 0.005 * (page - 1) * limit
+    return cost * 0.1 if snapshot else cost
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, reason: str, retry_after: Optional[float] = None):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict:
+        if self.retry_after is None:
+            return {}
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost: float, rate: float, burst: float) -> float:
+        """
+        取出 `cost` 個 token，成功回傳 0，否則回傳要等幾秒才夠。
+        """
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < cost:
+            return (cost - self.tokens) / rate
+        self.tokens -= cost
+        return 0.0
+
+
+class AdmissionController:
+    """
+    在 event loop 中使用，不需要鎖。`enabled` 為 False 時只統計不拒絕。
+    """
+
+    def __init__(
+        self,
+        rate: float = CLIENT_RATE,
+        burst: float = CLIENT_BURST,
+        max_cost: float = MAX_COST,
+        max_concurrent: int = MAX_CONCURRENT_QUERIES,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT,
+        enabled: bool = True,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_cost = max_cost
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.enabled = enabled
+
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.waiting = 0
+        self.counters = Counter()
+
+    def bucket(self, client: str) -> TokenBucket:
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.burst)
+            if len(self.buckets) > MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        return bucket
+
+    def reject(self, status: int, reason: str, retry_after: Optional[float] = None) -> Rejected:
+        self.counters[f"rejected_{reason}"] += 1
+        return Rejected(status, reason, retry_after)
+
+    @asynccontextmanager
+    async def admit(self, client: str, cost: float):
+        """
+        取得執行查詢的許可，被拒絕時丟出 Rejected。
+        """
+        self.counters["requests"] += 1
+        if self.enabled:
+            if cost > self.max_cost:
+                raise self.reject(400, "too_expensive")
+            wait = self.bucket(client).take(cost, self.rate, self.burst)
+            if wait > 0:
+                raise self.reject(429, "rate_limited", wait)
+
+            if self.slots.locked():
+                if self.waiting >= self.max_queue:
+                    raise self.reject(429, "queue_full", self.queue_timeout)
+                self.counters["queued"] += 1
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    raise self.reject(429, "queue_timeout", self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+            else:
+                await self.slots.acquire()
+
+        self.counters["admitted"] += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.enabled:
+                self.slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "clients": len(self.buckets),
+            "requests": self.counters["requests"],
+            "admitted": self.counters["admitted"],
+            "queued": self.counters["queued"],
+            "rejected": {
+                reason: self.counters[f"rejected_{reason}"]
+                for reason in ("too_expensive", "rate_limited", "queue_full", "queue_timeout")
+            },
+        }
+
+
+def client_id(headers, host: Optional[str], trusted=TRUSTED_PROXIES) -> str:
+    """
+    連線來自 `trusted` 中的代理時依 CLIENT_HEADERS 辨識客戶端，否則使用連線 IP。
+    X-Forwarded-For 最前面的值可以由客戶端自己填寫，因此從後面往前取第一個不是代理的位址。
+    """
+    if host not in trusted:
+        return host or "unknown"
+    for name in CLIENT_HEADERS:
+        value = headers.get(name)
+        if not value:
+            continue
+        hops = [ip.strip() for ip in value.split(",") if ip.strip()]
+        for ip in reversed(hops):
+            if ip not in trusted:
+                return ip
+    return host or "unknown"
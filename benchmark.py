@@ -0,0 +1,400 @@
+"""
+效能測試
+
+    python benchmark.py products    比較 SQL 與商品快照回應 /products 的延遲
+    python benchmark.py storage     資料庫大小、各資料表/索引佔用的頁數，以及冷/熱快取下的查詢延遲
+    python benchmark.py history     模擬一年的價格變動，比較價格歷史與每日快照的儲存空間
+    python benchmark.py governor    對會限流的本機測試伺服器送出請求，比較有無 RequestGovernor 的結果
+    python benchmark.py normalize   以資料庫中的商品名稱與規格驗證規格解析的正確率，並測量大量商品的處理速度
+    python benchmark.py warmup      在新的 process 中比較有無預熱時，啟動後第一批 /products 查詢的延遲
+    python benchmark.py admission   一個客戶端大量送出昂貴查詢時，比較有無准入控制下一般使用者的延遲
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+import main
+from admission import AdmissionController
+from crawler.governor import RequestGovernor
+from database import DB_URL, PriceHistory, Product, Unit, create_session, engine
+from history import price_history, record_prices
+from main import PRODUCT_QUERIES, query_products
+from normalize import BASE_UNITS, normalize_sizes, parse_size, price_units
+from snapshot import ProductSnapshot
+
+
+def measure(func, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "mean": statistics.fmean(times),
+        "p50": times[len(times) // 2],
+        "p99": times[min(len(times) - 1, int(len(times) * 0.99))],
+    }
+
+
+def print_result(name: str, result: dict) -> None:
+    print(f"{name:<24} " + "  ".join(f"{k}={v:8.3f}ms" for k, v in result.items()))
+
+
+def bench_products(repeat: int) -> None:
+    snapshot = ProductSnapshot.from_database()
+
+    for params in PRODUCT_QUERIES:
+        print(params)
+        sql_total, _ = query_products(**params)
+        snap_total, _ = snapshot.query(**params)
+        if sql_total != snap_total:
+            print(f"  !! total_count mismatch: sql={sql_total} snapshot={snap_total}")
+
+        print_result("  sql", measure(lambda: query_products(**params), repeat))
+        print_result("  snapshot", measure(lambda: snapshot.query(**params), repeat))
+
+
+def bench_storage(repeat: int) -> None:
+    path = DB_URL.removeprefix("sqlite:///")
+    conn = sqlite3.connect(path)
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    print(f"database size: {os.path.getsize(path) / 1024:.1f} KiB (page size {page_size})")
+    for name, pages, size in conn.execute(
+        "SELECT name, count(*), sum(pgsize) FROM dbstat GROUP BY name ORDER BY 3 DESC"
+    ):
+        print(f"  {name:<32} {pages:>6} pages {size / 1024:>10.1f} KiB")
+    conn.close()
+
+    # 冷快取: 每次查詢都換新連線，SQLite 的 page cache 是空的 (OS 的檔案快取仍在)
+    def cold(params):
+        engine.dispose()
+        query_products(**params)
+
+    for params in PRODUCT_QUERIES:
+        print(params)
+        print_result("  cold", measure(lambda: cold(params), repeat))
+        print_result("  warm", measure(lambda: query_products(**params), repeat))
+
+
+def bench_history(repeat: int, products: int = 6810, days: int = 365, change_rate: float = 0.02) -> None:
+    """
+    每天約有 `change_rate` 比例的商品變價，
+    比較只記錄變動的價格歷史與每天存一份全部價格的快照。
+    """
+    rng = random.Random(0)
+    prices = {pid: rng.randint(10, 500) for pid in range(1, products + 1)}
+    start = date.today() - timedelta(days=days - 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        history_path = os.path.join(tmp, "history.db")
+        snapshot_path = os.path.join(tmp, "snapshot.db")
+
+        history_engine = create_engine(f"sqlite:///{history_path}")
+        PriceHistory.__table__.create(history_engine)
+        session = sessionmaker(bind=history_engine)()
+
+        daily = Table(
+            "daily_prices",
+            MetaData(),
+            Column("product_id", Integer, primary_key=True),
+            Column("day", Integer, primary_key=True),
+            Column("price", Integer),
+            sqlite_with_rowid=False,
+        )
+        snapshot_engine = create_engine(f"sqlite:///{snapshot_path}")
+        daily.create(snapshot_engine)
+
+        elapsed = 0.0
+        for n in range(days):
+            today = start + timedelta(days=n)
+            for pid in rng.sample(sorted(prices), int(products * change_rate)):
+                prices[pid] = max(1, prices[pid] + rng.randint(-20, 20))
+
+            t = time.perf_counter()
+            record_prices(session, prices, today=today)
+            session.commit()
+            elapsed += time.perf_counter() - t
+
+            with snapshot_engine.begin() as conn:
+                conn.execute(insert(daily), [{"product_id": p, "day": n, "price": v} for p, v in prices.items()])
+
+        for e in (history_engine, snapshot_engine):
+            with e.connect() as conn:
+                conn.exec_driver_sql("VACUUM")
+
+        history_size = os.path.getsize(history_path)
+        snapshot_size = os.path.getsize(snapshot_path)
+        print(f"{products} products, {days} days, {change_rate:.0%} changed per day")
+        print(f"  price history    {history_size / 1024:>10.1f} KiB  (record_prices {elapsed / days * 1000:.1f}ms/run)")
+        print(f"  daily snapshots  {snapshot_size / 1024:>10.1f} KiB  ({snapshot_size / history_size:.1f}x)")
+
+        end = start + timedelta(days=days - 1)
+        for span in (30, 365):
+            pids = [rng.randint(1, products) for _ in range(repeat)]
+            it = iter(pids)
+            result = measure(lambda: price_history(session, next(it), end - timedelta(days=span - 1), end), repeat)
+            print_result(f"  range {span} days", result)
+        session.close()
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """
+    模擬會限流的網站: 同時請求數或每秒請求數超過上限時回傳 429 與 Retry-After，
+    同時處理的請求越多回應越慢。
+    """
+
+    max_concurrent = 4
+    max_per_second = 30
+    lock = threading.Lock()
+    in_flight = 0
+    recent = deque()
+
+    def do_GET(self):
+        cls = type(self)
+        now = time.monotonic()
+        with cls.lock:
+            while cls.recent and cls.recent[0] < now - 1:
+                cls.recent.popleft()
+            throttled = cls.in_flight >= cls.max_concurrent or len(cls.recent) >= cls.max_per_second
+            if not throttled:
+                cls.in_flight += 1
+                cls.recent.append(now)
+                load = cls.in_flight
+
+        if throttled:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        time.sleep(0.01 * load)
+        with cls.lock:
+            cls.in_flight -= 1
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_governor(requests_count: int, workers: int = 16) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    print(
+        f"{requests_count} requests, {workers} workers, server allows "
+        f"{ThrottlingHandler.max_concurrent} concurrent / {ThrottlingHandler.max_per_second} per second"
+    )
+
+    def run(name, fetch):
+        session = requests.Session()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            statuses = list(executor.map(lambda _: fetch(session).status_code, range(requests_count)))
+        elapsed = time.perf_counter() - start
+        ok = statuses.count(200)
+        print(
+            f"  {name:<12} {ok}/{requests_count} ok, {statuses.count(429)} failed with 429, "
+            f"{elapsed:.2f}s ({ok / elapsed:.1f} ok/s)"
+        )
+        session.close()
+
+    # 不控制速率，被限流就立即重試 (與 governor 相同的重試次數)
+    def ungoverned(session):
+        for _ in range(governor.max_retries + 1):
+            resp = session.get(url, timeout=10)
+            if resp.status_code != 429:
+                break
+        return resp
+
+    governor = RequestGovernor(rate=100, max_limit=workers)
+    run("ungoverned", ungoverned)
+    run("governor", lambda session: governor.send(url, lambda: session.get(url, timeout=10)))
+    for host, stats in governor.stats().items():
+        print(f"  {host}: {stats}")
+    server.shutdown()
+
+
+def bench_normalize(rows: int = 500_000) -> None:
+    """
+    正確率: 用已經是基本單位的商品，比較從名稱解析出的規格與資料庫中的規格 (誤差 1% 內視為正確)。
+    速度: 將商品名稱複製成 `rows` 筆各不相同的字串，測量解析與計算 price_unit 的時間。
+    """
+    session = create_session()
+    corpus = (
+        session.query(Product.name, Product.spec, Unit.name, Product.price)
+        .join(Unit, Product.unit_id == Unit.id)
+        .filter(Unit.name.in_(BASE_UNITS))
+        .all()
+    )
+    session.close()
+    names, specs, units, prices = (np.array(c, dtype=object) for c in zip(*corpus))
+    specs = specs.astype(np.float64)
+
+    parse_size.cache_clear()
+    parsed_specs, parsed_units = normalize_sizes(names)
+    parsed = parsed_units != ""
+    correct = parsed & (parsed_units == units) & np.isclose(parsed_specs, specs, rtol=0.01)
+    print(f"{len(names)} products with {', '.join(BASE_UNITS)} specs")
+    print(f"  parsed      {parsed.sum():>6} ({parsed.mean():.1%})")
+    print(
+        f"  correct     {correct.sum():>6} ({correct.mean():.1%} of all, {correct.sum() / parsed.sum():.1%} of parsed)"
+    )
+    for unit in BASE_UNITS:
+        mask = units == unit
+        if mask.any():
+            print(f"    {unit:<4} {correct[mask].sum():>6}/{mask.sum():<6} ({correct[mask].mean():.1%})")
+
+    # 最常見的錯誤是名稱只寫單件規格，資料庫中是整組的數量 (例如 "80g" 五包 400g)
+    wrong = np.flatnonzero(parsed & ~correct)
+    multiple = np.isclose(specs[wrong] / parsed_specs[wrong] % 1, 0) & (parsed_units[wrong] == units[wrong])
+    print(f"  wrong       {len(wrong):>6} ({multiple.sum()} are whole multiples of the parsed size), e.g.")
+    for i in wrong[:5]:
+        print(f"    {names[i]!r}: parsed {parsed_specs[i]:g}{parsed_units[i]}, stored {specs[i]:g}{units[i]}")
+
+    # 每筆都不同的字串 (最差情況) 與重複的字串 (實際上同一批商品每次更新都會再出現)
+    copies = -(-rows // len(names))
+    distinct = [f"{name} #{n}" for n in range(copies) for name in names][:rows]
+    repeated = np.resize(names, rows)
+    all_prices = np.resize(prices.astype(np.float64), rows)
+
+    for label, texts in (("distinct", distinct), ("repeated", repeated)):
+        parse_size.cache_clear()
+        start = time.perf_counter()
+        big_specs, _ = normalize_sizes(texts)
+        elapsed = time.perf_counter() - start
+        print(f"{rows} {label} strings: parse {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s)")
+
+    start = time.perf_counter()
+    price_units(all_prices, big_specs)
+    print(f"price_unit for {rows} rows: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+# 在新的 process 中執行，模擬剛部署好的服務收到的第一批請求
+WARM_UP_PROBE = """
+import json, sys, time
+import main
+if sys.argv[1] == "warm":
+    main.warm_up()
+times = []
+for params in main.PRODUCT_QUERIES * 3:
+    start = time.perf_counter()
+    main.query_products(**params)
+    times.append((time.perf_counter() - start) * 1000)
+print(json.dumps(times))
+"""
+
+
+def bench_warmup(repeat: int) -> None:
+    for mode in ("cold", "warm"):
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", WARM_UP_PROBE, mode], capture_output=True, text=True, check=True
+            )
+            runs.append(json.loads(out.stdout.splitlines()[-1]))
+        first = [run[0] for run in runs]
+        rest = sorted(t for run in runs for t in run[1:])
+        print(
+            f"{mode:<5} first request {statistics.fmean(first):8.3f}ms  "
+            f"next {len(runs[0]) - 1}: mean {statistics.fmean(rest):7.3f}ms  max {rest[-1]:7.3f}ms"
+        )
+
+
+async def admission_load(enabled: bool, seconds: float, abusers: int = 32, users: int = 4) -> None:
+    # httpx 只有這個測試會用到，不在 requirements.txt 中
+    import httpx
+
+    main.admission = AdmissionController(enabled=enabled)
+    transport = httpx.ASGITransport(app=main.app)
+    deadline = time.perf_counter() + seconds
+    latencies, statuses = [], Counter()
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+
+        async def abuser():
+            # 同一個 IP 不停送出每頁 1000 筆、多個關鍵字的查詢
+            headers = {"cf-connecting-ip": "10.0.0.1"}
+            params = {"query": "a e i o u", "limit": 1000}
+            while time.perf_counter() < deadline:
+                resp = await client.get("/api/v1/products", params=params, headers=headers)
+                statuses[("abuser", resp.status_code)] += 1
+                if resp.status_code == 429:
+                    await asyncio.sleep(0.01)
+
+        async def user(n):
+            # 一般使用者瀏覽分類，每 50ms 一次
+            headers = {"cf-connecting-ip": f"10.0.1.{n}"}
+            queries = [q for q in PRODUCT_QUERIES if q.get("limit", 10) <= 20]
+            i = 0
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                resp = await client.get("/api/v1/products", params=queries[i % len(queries)], headers=headers)
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[("user", resp.status_code)] += 1
+                i += 1
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(*(abuser() for _ in range(abusers)), *(user(n) for n in range(users)))
+
+    latencies.sort()
+    print(
+        f"admission {'on ' if enabled else 'off'}  users: p50 {latencies[len(latencies) // 2]:7.1f}ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99)]:7.1f}ms  "
+        + "  ".join(f"{who} {code}={count}" for (who, code), count in sorted(statuses.items()))
+    )
+    if enabled:
+        print(f"  {main.admission.stats()}")
+
+
+def bench_admission(seconds: float = 5.0) -> None:
+    for enabled in (False, True):
+        asyncio.run(admission_load(enabled, seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PriceScout benchmarks")
+    parser.add_argument(
+        "target", choices=["products", "storage", "history", "governor", "normalize", "warmup", "admission"]
+    )
+    parser.add_argument("-n", "--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.target == "products":
+        bench_products(args.repeat)
+    elif args.target == "storage":
+        bench_storage(args.repeat)
+    elif args.target == "history":
+        bench_history(args.repeat)
+    elif args.target == "governor":
+        bench_governor(args.repeat)
+    elif args.target == "normalize":
+        bench_normalize()
+    elif args.target == "warmup":
+        bench_warmup(min(args.repeat, 10))
+    elif args.target == "admission":
+        bench_admission()
@@ -0,0 +1,168 @@
+"""
+商品異動紀錄 (delta sync)
+
+每次執行 update.py 都是一個新的批次 (generation)，編號遞增。
+更新前後比對商品的價格與規格，把新增、變價、規格變動、刪除的商品記錄到 `product_changes`，
+客戶端只要帶上次同步到的批次編號，就能只取得之後的異動。
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import func
+
+from database import Channel, Generation, Product, ProductChange, UpdateRun, create_session
+
+# product_id -> (pid, channel_id, price, price_unit, spec, unit_id)
+State = Dict[int, Tuple[int, int, int, float, float, int]]
+
+# price_unit 四捨五入到小數第 4 位，舊資料與不同程式的進位方式可能差一位，這個範圍內不算變價
+PRICE_UNIT_TOLERANCE = 1.5e-4
+
+
+def same_price_unit(a: Optional[float], b: Optional[float]) -> bool:
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= PRICE_UNIT_TOLERANCE
+
+
+def begin_generation() -> int:
+    session = create_session()
+    generation = Generation(started_at=datetime.now())
+    session.add(generation)
+    session.commit()
+    generation_id = generation.id
+    session.close()
+    return generation_id
+
+
+def finish_generation(generation_id: int) -> None:
+    session = create_session()
+    session.get(Generation, generation_id).finished_at = datetime.now()
+    session.commit()
+    session.close()
+
+
+def close_abandoned_generations(channels: Optional[Iterable[str]] = None) -> int:
+    """
+    結束已經不會再繼續的批次 (例如 update.py 被強制結束，或是程式在 run 完成與批次結束之間當掉)，
+    否則 latest_generation() 會永遠停在它之前。
+    排程中還沒完成 (planning / running) 的 run 之後會繼續，它們的批次保持進行中；
+    有指定 `channels` 時，其他通路商還沒完成的 run 不會再被排程，改為 "failed" 並結束它們的批次。
+    update.py 與 scheduler.py 啟動時呼叫，回傳結束的批次數。
+    """
+    session = create_session()
+    try:
+        now = datetime.now()
+        unfinished = session.query(UpdateRun).filter(UpdateRun.status.in_(("planning", "running")))
+        if channels is not None:
+            for run in unfinished.filter(UpdateRun.channel.not_in(list(channels))):
+                run.status = "failed"
+                run.finished_at = now
+            session.flush()
+        resumable = unfinished.with_entities(UpdateRun.generation_id)
+
+        abandoned = (
+            session.query(Generation)
+            .filter(Generation.finished_at.is_(None), Generation.id.not_in(resumable.scalar_subquery()))
+            .all()
+        )
+        for generation in abandoned:
+            generation.finished_at = now
+        session.commit()
+        return len(abandoned)
+    finally:
+        session.close()
+
+
+def latest_generation(session) -> int:
+    """
+    可以同步到的最新批次編號: 這個批次與之前的批次都已完成，還沒有任何批次時為 0。
+
+    不同通路商的批次會同時進行，編號較大的批次可能先完成，
+    如果直接用最大的已完成批次，之後才完成的較小批次的異動就永遠不會被同步到。
+    """
+    unfinished = session.query(func.min(Generation.id)).filter(Generation.finished_at.is_(None)).scalar_subquery()
+    latest = (
+        session.query(func.max(Generation.id))
+        .filter(Generation.finished_at.isnot(None))
+        .filter((Generation.id < unfinished) | unfinished.is_(None))
+        .scalar()
+    )
+    return latest or 0
+
+
+def product_state(session, channel: Optional[str] = None, ids: Optional[Iterable[int]] = None) -> State:
+    """
+    取得商品目前的價格與規格，可以用通路商或商品 id 限制範圍。
+    """
+    query = session.query(
+        Product.id, Product.pid, Product.channel_id, Product.price, Product.price_unit, Product.spec, Product.unit_id
+    )
+    if channel:
+        query = query.filter(Product.channel_id == Channel.id_of(channel))
+    if ids is not None:
+        query = query.filter(Product.id.in_(list(ids)))
+    return {id: tuple(state) for id, *state in query}
+
+
+def record_changes(
+    session,
+    generation_id: int,
+    before: State,
+    channel: Optional[str] = None,
+    ids: Optional[Iterable[int]] = None,
+) -> int:
+    """
+    將目前的商品狀態與更新前的 `before` 比對，記錄異動。
+    價格變動為 "price"，價格不變但規格或單位變動 (例如 normalize.py 換算) 為 "spec"，
+    price_unit 只差在進位 (PRICE_UNIT_TOLERANCE 以內) 不算變動。
+    `channel` 與 `ids` 要與取得 `before` 時的範圍相同。
+    回傳異動筆數。
+    """
+    session.flush()
+    after = product_state(session, channel, ids)
+
+    changes = []
+    for product_id, (pid, channel_id, price, price_unit, spec, unit_id) in after.items():
+        old = before.get(product_id)
+        if old is None:
+            op = "new"
+        elif old[2] != price:
+            op = "price"
+        elif old[4:] != (spec, unit_id):
+            op = "spec"
+        elif not same_price_unit(old[3], price_unit):
+            op = "price"
+        else:
+            continue
+        changes.append(
+            ProductChange(
+                generation_id=generation_id,
+                product_id=product_id,
+                pid=pid,
+                channel_id=channel_id,
+                op=op,
+                price=price,
+                price_unit=price_unit,
+                spec=spec,
+                unit_id=unit_id,
+            )
+        )
+
+    for product_id in before.keys() - after.keys():
+        pid, channel_id = before[product_id][:2]
+        changes.append(
+            ProductChange(
+                generation_id=generation_id,
+                product_id=product_id,
+                pid=pid,
+                channel_id=channel_id,
+                op="removed",
+            )
+        )
+
+    session.add_all(changes)
+    return len(changes)
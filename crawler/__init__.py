@@ -1,2 +1,5 @@
 from .cr4_crawler import CR4_Crawler
+from .fingerprint import FingerprintStore
+from .governor import GOVERNOR, RequestGovernor
 from .px_crawler import PX_Crawler
+from .telemetry import Telemetry
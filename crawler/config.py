@@ -1,5 +1,18 @@
 TIMEOUT = 10
 
+# 要爬取價格的全聯門市，第一間的價格會作為商品的預設價格
+PX_STORES = ("025700",)
+
+# 請求速率控制 (crawler/governor.py)，以下都是對同一個 host 的限制
+# 同時送出的請求數上限，實際上限會依回應狀況在 1 到這個值之間調整
+MAX_CONCURRENT_REQUESTS = 4
+# 每秒請求數上限 (token bucket)
+REQUESTS_PER_SECOND = 5
+# 回應時間超過這個秒數視為伺服器忙碌，降低請求速率
+TARGET_LATENCY = 3.0
+# 被限流 (429 / 503) 時最多重試幾次
+MAX_RETRIES = 3
+
 DEFAULT_HEADER = {
     'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
     'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36',
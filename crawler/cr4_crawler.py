@@ -11,12 +11,23 @@ from bs4 import BeautifulSoup
 from tqdm import tqdm
 
 from .config import DEFAULT_HEADER, GOODS_FIELDS, TIMEOUT
+from .fingerprint import FingerprintStore
+from .governor import GOVERNOR, RequestGovernor
+from .telemetry import Telemetry
 
 
 class CR4_Crawler:
     BASED_URL = "https://online.carrefour.com.tw"
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        fingerprints: FingerprintStore = None,
+        governor: RequestGovernor = GOVERNOR,
+        telemetry: Telemetry = None,
+    ) -> None:
+        self.fingerprints = fingerprints
+        self.governor = governor
+        self.telemetry = telemetry if telemetry is not None else Telemetry(None)
         self.now = datetime.now()
         self.session = requests.Session()
         self.session.headers.update(DEFAULT_HEADER)
@@ -57,15 +68,22 @@ class CR4_Crawler:
             writer.writeheader()
             writer.writerows(data)
 
-    def get(self, path: str, *, params=None, **kwargs) -> BeautifulSoup:
+    def get(self, path: str, *, params=None, event=None, **kwargs) -> BeautifulSoup:
+        """
+        `event` 是呼叫端建立的請求紀錄，可以在 with 區塊中繼續記錄解析結果。
+        """
         url = self.BASED_URL + path
-        resp = self.session.get(url, timeout=TIMEOUT, params=params, **kwargs)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "lxml")
+        with event or self.telemetry.request("cr4/page") as event:
+            resp = self.governor.send(
+                url, lambda: self.session.get(url, timeout=TIMEOUT, params=params, **kwargs), event
+            )
+            event.response(resp.status_code, len(resp.content))
+            resp.raise_for_status()
+            soup = BeautifulSoup(resp.text, "lxml")
         return soup
 
     def process_categories(self, save_result=True):
-        soup = self.get("/")
+        soup = self.get("/", event=self.telemetry.request("cr4/home"))
         data = {}
 
         level1 = soup.find_all(class_="first-level-item")
@@ -103,16 +121,31 @@ class CR4_Crawler:
 
     def get_goods(self, cat_path: str, position=None, save_result=True):
         url = "/zh/" + cat_path
-        soup = self.get(url)
-        # print(soup.title)
-        total_count = int(soup.find(class_="resultCount number").text.strip())
+        with self.telemetry.request("cr4/category", cat_path) as event:
+            soup = self.get(url, event=event)
+            # print(soup.title)
+            total_count = int(soup.find(class_="resultCount number").text.strip())
 
         data = []
+        start, changed = 0, False
 
         with tqdm(total=total_count, desc=cat_path + ": ", position=None, leave=False) as pbar:
-            while len(data) < total_count:
-                soup = self.get(url, params={"start": len(data)})
-                items = soup.find_all(class_="hot-recommend-item")
+            while start < total_count:
+                with self.telemetry.request("cr4/goods", cat_path) as event:
+                    soup = self.get(url, params={"start": start}, event=event)
+                    items = soup.find_all(class_="hot-recommend-item")
+                    event.items = len(items)
+                if not items:
+                    break
+                key = f"cr4/{cat_path}/{start}"
+                start += len(items)
+
+                # 頁面其他部分每次都不同，只比對商品列表
+                if self.fingerprints is not None and not self.fingerprints.check(key, "".join(map(str, items))):
+                    pbar.update(len(items))
+                    continue
+                changed = True
+
                 for item in items:
                     info = item.select_one(".box-img > a")
                     d = {
@@ -133,6 +166,9 @@ class CR4_Crawler:
                     data.append(d)
                     pbar.update(1)
 
+        if self.fingerprints is not None:
+            self.fingerprints.record(f"cr4/{cat_path}", changed)
+
         data.sort(key=lambda x: x["pid"])
 
         # print(data)
@@ -143,7 +179,6 @@ class CR4_Crawler:
 
     def get_all_products(self, categories=None):
         stop = False
-        errors = []
         if categories is None:
             if not hasattr(self, "categories"):
                 self.process_categories(save_result=False)
@@ -168,8 +203,9 @@ class CR4_Crawler:
                     except KeyboardInterrupt:
                         stop = True
                         break
-                    except Exception as e:
-                        errors.append([cn1, cn2, cn3, str(e)])
+                    except Exception:
+                        # 失敗的分類已記錄在 telemetry (cr4/category、cr4/goods)，留給之後重爬
+                        pass
                     # stop = True
                     # break
                 if stop:
@@ -177,19 +213,7 @@ class CR4_Crawler:
             if stop:
                 break
 
-        print("Errors:")
-        print(errors)
-        self.write_json("debug.json", {"time": self.now.isoformat(), "errors": errors})
-
-
-# def load_error():
-#     with open('carrefour/debug.json', 'r', encoding='utf-8') as f:
-#         data = json.load(f)['errors']
-#     for cat in data:
-#         cat_path = '/'.join(map(my_slugify, cat))
-#         print(cat_path)
-#         d = get_goods(cat_path)
-#         write_csv(f'{cat_path}.csv', d, GOODS_FIELDS)
-
+        self.telemetry.close()
 
-# load_error()
+        if self.fingerprints is not None:
+            print(self.fingerprints.summary())
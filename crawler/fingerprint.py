@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import threading
+from collections import Counter
+from typing import Callable, Iterable, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+STATE_DIR = "data/crawl_state"
+
+# 以下只在 prioritize(defer=True) 時使用，預設每次都會爬所有項目
+# 少於這個檢查次數的項目每次都要爬
+MIN_CHECKS = 3
+# 不常變動的項目最多隔幾次才重新檢查
+MAX_INTERVAL = 7
+
+
+class FingerprintStore:
+    """
+    記錄每個分類、每一頁上次爬到的內容雜湊 (或 ETag / Last-Modified)，
+    內容沒變的頁面可以略過解析與寫入資料庫。
+    同時統計每個項目實際變動的頻率，用來決定爬取的優先順序。
+    可以在多個執行緒中共用 (例如同時爬取多個分類)。
+    """
+
+    def __init__(self, name: str, state_dir: str = STATE_DIR):
+        self.name = name
+        self.path = os.path.join(state_dir, f"{name}.json")
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        else:
+            state = {}
+        self.run = state.get("run", 0) + 1
+        self.entries = state.get("entries", {})
+        self.stats = Counter()
+        self.journal = None
+        self.lock = threading.RLock()
+
+    def save(self):
+        """
+        要在資料寫入資料庫之後才儲存，否則中斷時會把沒寫入的頁面當成沒變動。
+        """
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"run": self.run, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def digest(payload) -> str:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        return hashlib.sha1(payload).hexdigest()
+
+    def begin(self) -> None:
+        """
+        開始記錄修改，之後可以用 rollback() 還原 (例如該批資料沒有成功寫入資料庫)。
+        """
+        self.journal = {}
+
+    def commit(self) -> None:
+        self.journal = None
+
+    def rollback(self) -> None:
+        for key, entry in (self.journal or {}).items():
+            if entry is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = entry
+        self.journal = None
+
+    def _entry(self, key: str) -> dict:
+        if self.journal is not None and key not in self.journal:
+            entry = self.entries.get(key)
+            self.journal[key] = dict(entry) if entry is not None else None
+        return self.entries.setdefault(key, {"checks": 0, "changes": 0, "last_run": 0})
+
+    def record(self, key: str, changed: bool) -> bool:
+        """
+        記錄一次檢查結果，用於統計變動頻率。
+        """
+        with self.lock:
+            entry = self._entry(key)
+            entry["checks"] += 1
+            entry["changes"] += changed
+            entry["last_run"] = self.run
+        return changed
+
+    def check(self, key: str, payload) -> bool:
+        """
+        比對內容雜湊，回傳內容是否有變動。
+        """
+        digest = self.digest(payload)
+        with self.lock:
+            entry = self._entry(key)
+            changed = entry.get("digest") != digest
+            entry["digest"] = digest
+
+            self.stats["pages"] += 1
+            self.stats["unchanged"] += not changed
+            return self.record(key, changed)
+
+    def validators(self, key: str) -> dict:
+        """
+        條件式請求的 header (If-None-Match / If-Modified-Since)。
+        """
+        entry = self.entries.get(key, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def remember_validators(self, key: str, headers) -> None:
+        with self.lock:
+            entry = self._entry(key)
+            entry["etag"] = headers.get("ETag")
+            entry["last_modified"] = headers.get("Last-Modified")
+
+    def not_modified(self, key: str) -> bool:
+        """
+        伺服器回傳 304 Not Modified。
+        """
+        with self.lock:
+            self.stats["pages"] += 1
+            self.stats["unchanged"] += 1
+            self.stats["not_modified"] += 1
+            return self.record(key, False)
+
+    def change_rate(self, key: str) -> float:
+        entry = self.entries.get(key)
+        if entry is None:
+            return 1.0
+        # Laplace smoothing，避免只檢查過一兩次就被判定為不會變動
+        return (entry["changes"] + 1) / (entry["checks"] + 2)
+
+    def due(self, key: str) -> bool:
+        """
+        依變動頻率決定這次要不要爬，越少變動的項目隔越久才重新檢查。
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry["checks"] < MIN_CHECKS:
+            return True
+        interval = min(MAX_INTERVAL, max(1, round(1 / self.change_rate(key))))
+        return self.run - entry["last_run"] >= interval
+
+    def prioritize(self, items: Iterable[T], key: Callable[[T], str], defer: bool = False) -> Tuple[List[T], List[T]]:
+        """
+        回傳 (這次要爬的項目, 延後的項目)，要爬的項目依變動頻率由高到低排序。
+        預設所有項目都要爬，只調整順序；`defer` 為 True 時才依 due() 延後不常變動的項目，
+        延後的商品價格可能最多過時 MAX_INTERVAL 次更新。
+        """
+        due, deferred = [], []
+        for item in items:
+            (due if not defer or self.due(key(item)) else deferred).append(item)
+        due.sort(key=lambda item: self.change_rate(key(item)), reverse=True)
+        self.stats["deferred"] += len(deferred)
+        return due, deferred
+
+    def summary(self) -> str:
+        pages, unchanged = self.stats["pages"], self.stats["unchanged"]
+        ratio = unchanged / pages if pages else 0
+        return (
+            f"{self.name} run {self.run}: {unchanged}/{pages} pages unchanged ({ratio:.1%}, "
+            f"{self.stats['not_modified']} by 304), {self.stats['deferred']} items deferred"
+        )
@@ -0,0 +1,221 @@
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from .config import (
+    MAX_CONCURRENT_REQUESTS,
+    MAX_RETRIES,
+    REQUESTS_PER_SECOND,
+    TARGET_LATENCY,
+)
+
+# 視為被限流的狀態碼
+THROTTLED = (429, 503)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Retry-After 可以是秒數或 HTTP 日期。
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostState:
+    """
+    單一 host 的限流狀態:
+    - token bucket 控制每秒請求數
+    - AIMD 調整同時請求數上限: 順利時每次 +1/limit，被限流或變慢時減半
+    - 收到 Retry-After 時暫停到指定時間
+    """
+
+    def __init__(self, rate: float, max_limit: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+        self.max_limit = max_limit
+        self.limit = 1.0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.backoff = 1.0
+
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def try_acquire(self, now: float) -> float:
+        """
+        取得一個請求額度，成功回傳 0，否則回傳建議等待的秒數。
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        # 容量至少 1，速率降到每秒 1 次以下時才拿得到 token
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.in_flight >= int(self.limit):
+            return 0.05
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+
+        self.tokens -= 1
+        self.in_flight += 1
+        self.requests += 1
+        return 0.0
+
+    def release(self, now: float, latency: float, status: Optional[int], retry_after: Optional[float]) -> None:
+        self.in_flight -= 1
+        self.latency = latency if self.latency == 0 else 0.8 * self.latency + 0.2 * latency
+
+        if status in THROTTLED:
+            self.throttled += 1
+            if retry_after is None:
+                retry_after = self.backoff
+                self.backoff = min(60.0, self.backoff * 2)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.decrease()
+        elif status is None or status >= 500:
+            self.errors += 1
+            self.decrease()
+        elif latency > TARGET_LATENCY:
+            self.decrease()
+        else:
+            self.backoff = 1.0
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def decrease(self) -> None:
+        self.limit = max(1.0, self.limit / 2)
+        self.rate = max(0.5, self.rate / 2)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "limit": round(self.limit, 2),
+            "rate": round(self.rate, 2),
+            "latency": round(self.latency, 3),
+        }
+
+
+class Slot:
+    """
+    一次請求的額度，請求結束後用 record() 回報狀態碼。
+    """
+
+    def __init__(self, governor: "RequestGovernor", host: str):
+        self.governor = governor
+        self.host = host
+        self.status = None
+        self.retry_after = None
+        self.start = time.monotonic()
+
+    def record(self, status: int, headers=None) -> None:
+        self.status = status
+        if headers is not None:
+            self.retry_after = parse_retry_after(headers.get("Retry-After"))
+
+    @property
+    def throttled(self) -> bool:
+        return self.status in THROTTLED
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.governor.release(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.governor.release(self)
+
+
+class RequestGovernor:
+    """
+    所有爬蟲共用的請求控制，依 host 分別計算。
+
+        with governor.slot(url) as slot:
+            resp = session.get(url)
+            slot.record(resp.status_code, resp.headers)
+
+    非同步程式改用 `async with await governor.aslot(url) as slot`。
+    """
+
+    def __init__(
+        self,
+        rate: float = REQUESTS_PER_SECOND,
+        max_limit: int = MAX_CONCURRENT_REQUESTS,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.rate = rate
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.hosts: Dict[str, HostState] = {}
+        self.lock = threading.Lock()
+
+    def _try_acquire(self, host: str) -> float:
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = HostState(self.rate, self.max_limit)
+            return state.try_acquire(time.monotonic())
+
+    def slot(self, url: str) -> Slot:
+        host = urlsplit(url).netloc
+        while (wait := self._try_acquire(host)) > 0:
+            time.sleep(wait)
+        return Slot(self, host)
+
+    async def aslot(self, url: str) -> Slot:
+        host = urlsplit(url).netloc
+        while (wait := self._try_acquire(host)) > 0:
+            await asyncio.sleep(wait)
+        return Slot(self, host)
+
+    def release(self, slot: Slot) -> None:
+        now = time.monotonic()
+        with self.lock:
+            self.hosts[slot.host].release(now, now - slot.start, slot.status, slot.retry_after)
+
+    def send(self, url: str, func, event=None):
+        """
+        透過 `func()` 送出請求 (回傳 requests.Response)，被限流時依 Retry-After 等待後重試。
+        重試次數與等待額度的時間會記在 `event` (telemetry.RequestEvent)。
+        """
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            slot = self.slot(url)
+            if event is not None:
+                event.retries = attempt
+                event.wait += time.perf_counter() - start
+            with slot:
+                resp = func()
+                slot.record(resp.status_code, resp.headers)
+            if not slot.throttled or attempt == self.max_retries:
+                return resp
+
+    def stats(self) -> Dict[str, dict]:
+        with self.lock:
+            return {host: state.stats() for host, state in self.hosts.items()}
+
+
+# 預設共用的實例
+GOVERNOR = RequestGovernor()
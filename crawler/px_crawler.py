@@ -8,6 +8,9 @@ import requests
 from tqdm import tqdm
 
 from .config import DEFAULT_HEADER, GOODS_FIELDS, TIMEOUT
+from .fingerprint import FingerprintStore
+from .governor import GOVERNOR, RequestGovernor
+from .telemetry import Telemetry
 
 "https://pxgo.net/444Qp0r"
 
@@ -16,7 +19,21 @@ class PX_Crawler:
     API_URL = "https://mwebapi.pxgo.com.tw/api"
     SHOP_NO = "025700"
 
-    def __init__(self):
+    def __init__(
+        self,
+        fingerprints: FingerprintStore = None,
+        shop_no: str = SHOP_NO,
+        governor: RequestGovernor = GOVERNOR,
+        telemetry: Telemetry = None,
+    ):
+        """
+        `governor` 控制請求速率，預設與其他爬蟲共用。
+        `telemetry` 記錄每個請求，沒有設定時不記錄。
+        """
+        self.fingerprints = fingerprints
+        self.shop_no = shop_no
+        self.governor = governor
+        self.telemetry = telemetry if telemetry is not None else Telemetry(None)
         self.session = requests.Session()
         self.session.headers.update(DEFAULT_HEADER)
         self.login()
@@ -45,14 +62,18 @@ class PX_Crawler:
             writer.writeheader()
             writer.writerows(data)
 
-    def post(self, path: str, data):
+    def post_raw(self, path: str, data, event=None) -> requests.Response:
         url = self.path(path)
-        resp = self.session.post(url, json=data, timeout=TIMEOUT)
-        resp.raise_for_status()
-        if resp.json().get("message", None) not in ("操作成功", "success"):
-            print(resp.text)
-            raise RuntimeError(f"POST failed: {resp.text}")
-        return resp.json()["data"]
+        with event or self.telemetry.request(f"px{path}") as event:
+            resp = self.governor.send(url, lambda: self.session.post(url, json=data, timeout=TIMEOUT), event)
+            event.response(resp.status_code, len(resp.content))
+            resp.raise_for_status()
+            if resp.json().get("message", None) not in ("操作成功", "success"):
+                raise RuntimeError(f"POST failed: {resp.text}")
+        return resp
+
+    def post(self, path: str, data):
+        return self.post_raw(path, data).json()["data"]
 
     def login(self):
         if hasattr(self, "token"):  # Already logged in, ignore
@@ -68,11 +89,14 @@ class PX_Crawler:
 
     def get_categories(self):
         url = "/category/goodsCategoryQuery"
-        data = {"channel": 1, "shopNo": self.SHOP_NO}
+        data = {"channel": 1, "shopNo": self.shop_no}
         data = self.post(url, data)
         return data
 
-    def get_goods(self, category_id: int):
+    def get_goods_pages(self, category_id: int):
+        """
+        逐頁取得分類的商品，產生 (頁碼, 原始回應內容, 資料)。
+        """
         url = "/goods/goodsQuery"
         page, offset = 1, 100
         data = {
@@ -84,16 +108,30 @@ class PX_Crawler:
             "channel": 1,
             "pageNum": page,
             "pageSize": 100,
-            "shopNo": self.SHOP_NO,
+            "shopNo": self.shop_no,
         }
-        result = self.post(url, data)
+        with self.telemetry.request("px/goods", category_id) as event:
+            resp = self.post_raw(url, data, event)
+            result = resp.json()["data"]
+            event.items = len(result["goods"])
+        yield page, resp.content, result
 
         if result["total"] > page * offset:
             page += 1
             data["pageNum"] = page
-            r = self.post(url, data)
-            result["goods"].extend(r["goods"])
+            with self.telemetry.request("px/goods", category_id) as event:
+                resp = self.post_raw(url, data, event)
+                result = resp.json()["data"]
+                event.items = len(result["goods"])
+            yield page, resp.content, result
 
+    def get_goods(self, category_id: int):
+        result = None
+        for _, _, r in self.get_goods_pages(category_id):
+            if result is None:
+                result = r
+            else:
+                result["goods"].extend(r["goods"])
         return result
 
     def get_detail(self, good_id: str, goods_no: str, goods_barcode: str):
@@ -103,7 +141,7 @@ class PX_Crawler:
             "goodsNo": goods_no,
             "goodsBarcode": goods_barcode,
             "channel": 1,
-            "shopNo": self.SHOP_NO,
+            "shopNo": self.shop_no,
         }
 
         data = self.post(url, data)
@@ -133,14 +171,27 @@ class PX_Crawler:
         if save_result:
             self.write_csv("px/categories.csv", self.CATEGORYS_FIELDS, data.values())
 
+    def iter_goods(self, category_id: int):
+        """
+        有設定 fingerprints 時，內容與上次相同的頁面會直接略過，不解析。
+        """
+        if self.fingerprints is None:
+            yield from self.get_goods(category_id)["goods"]
+            return
+
+        changed = False
+        for page, content, result in self.get_goods_pages(category_id):
+            if self.fingerprints.check(f"px/{self.shop_no}/{category_id}/{page}", content):
+                changed = True
+                yield from result["goods"]
+        self.fingerprints.record(f"px/{self.shop_no}/{category_id}", changed)
+
     def process_goods(self, category_id: int, save_result=True):
         if not hasattr(self, "categories"):
             self.process_categories(save_result=False)
-        goods = self.get_goods(category_id)
-        # self.write_json('px/raw_goods.json', goods)
 
         data = []
-        for good in goods["goods"]:
+        for good in self.iter_goods(category_id):
             d = {
                 "barcode": good["goodsBarcode"],
                 "pid": good["goodsId"],
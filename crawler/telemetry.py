@@ -0,0 +1,304 @@
+"""
+爬蟲的請求紀錄
+
+每個請求寫一行 JSON 到 `data/telemetry/<name>/<開始時間>.jsonl`:
+
+    {"ts": 1729300000.1, "class": "px/goods", "category": 123, "key": null, "status": 200, "wait": 0.2,
+     "latency": 0.412, "bytes": 48213, "retries": 0, "parse": 0.008, "items": 100, "error": null}
+
+`key` 是單一商品的請求 (例如家樂福商品頁) 的 pid，用來找出失敗的商品。
+
+`wait` 是等待 RequestGovernor 給予請求額度的時間，不算在 `latency` 中。
+
+爬完後 close() 會寫出同名的 `.summary.json`，並與上一次的摘要比較:
+
+    python -m crawler.telemetry data/telemetry/cr4            最近一次與前一次比較
+    python -m crawler.telemetry a.summary.json b.summary.json  指定兩次比較
+"""
+
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Optional
+
+import requests
+
+TELEMETRY_DIR = "data/telemetry"
+
+# 摘要中列出的最慢分類數
+SLOWEST_CATEGORIES = 10
+
+# 與上一次比較時，變差超過這個比例會標示出來
+REGRESSION_THRESHOLD = 0.2
+
+
+def error_kind(exc: BaseException) -> str:
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return f"HTTP {exc.response.status_code}"
+    status = getattr(exc, "status", None)  # aiohttp.ClientResponseError
+    if isinstance(status, int):
+        return f"HTTP {status}"
+    return type(exc).__name__
+
+
+class RequestEvent:
+    """
+    一次請求的紀錄，離開 with 區塊時寫出。
+    可以巢狀使用 (外層建立、內層補上回應)，只有最外層離開時才會寫出。
+    """
+
+    __slots__ = (
+        "telemetry",
+        "url_class",
+        "category",
+        "key",
+        "status",
+        "bytes",
+        "retries",
+        "wait",
+        "items",
+        "error",
+        "ts",
+        "start",
+        "latency",
+        "received",
+        "parse",
+        "depth",
+    )
+
+    def __init__(self, telemetry: "Telemetry", url_class: str, category=None, key=None):
+        self.telemetry = telemetry
+        self.url_class = url_class
+        self.category = category
+        self.key = key
+        self.status = None
+        self.bytes = 0
+        self.retries = 0
+        self.wait = 0.0
+        self.items = None
+        self.error = None
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        self.latency = None
+        self.received = None
+        self.parse = None
+        self.depth = 0
+
+    def response(self, status: int, size: int) -> None:
+        """
+        收到回應時呼叫，之後到離開 with 區塊的時間算是解析時間。
+        """
+        self.received = time.perf_counter()
+        self.latency = self.received - self.start - self.wait
+        self.status = status
+        self.bytes = size
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None and self.error is None and not isinstance(exc_value, KeyboardInterrupt):
+            self.error = error_kind(exc_value)
+        self.depth -= 1
+        if self.depth == 0:
+            now = time.perf_counter()
+            if self.received is None:
+                self.latency = now - self.start - self.wait
+            else:
+                self.parse = now - self.received
+            self.telemetry.emit(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "ts": round(self.ts, 3),
+            "class": self.url_class,
+            "category": self.category,
+            "key": self.key,
+            "status": self.status,
+            "wait": round(self.wait, 4),
+            "latency": round(self.latency, 4),
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "parse": None if self.parse is None else round(self.parse, 4),
+            "items": self.items,
+            "error": self.error,
+        }
+
+
+class Telemetry:
+    """
+    一次爬取的請求紀錄與統計，可以在多個執行緒中共用。
+    `name` 為 None 時不做任何紀錄。
+    """
+
+    def __init__(self, name: Optional[str], directory: str = TELEMETRY_DIR):
+        self.name = name
+        self.enabled = name is not None
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+        self.latency = defaultdict(list)
+        self.classes = defaultdict(Counter)
+        self.categories = defaultdict(lambda: [0.0, 0])
+        self.errors = Counter()
+        self.totals = Counter()
+
+        self.path = None
+        self.file = None
+        if self.enabled:
+            run_dir = os.path.join(directory, name)
+            os.makedirs(run_dir, exist_ok=True)
+            self.path = os.path.join(run_dir, f"{self.started_at:%Y%m%d-%H%M%S}.jsonl")
+            self.file = open(self.path, "a", encoding="utf-8", buffering=1 << 16)
+
+    def request(self, url_class: str, category=None, key=None) -> RequestEvent:
+        return RequestEvent(self, url_class, category, key)
+
+    def emit(self, event: RequestEvent) -> None:
+        if not self.enabled:
+            return
+        line = json.dumps(event.to_dict(), ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+
+            self.latency[event.url_class].append(event.latency)
+            stats = self.classes[event.url_class]
+            stats["bytes"] += event.bytes
+            stats["parse"] += event.parse or 0
+            stats["items"] += event.items or 0
+
+            self.totals["requests"] += 1
+            self.totals["bytes"] += event.bytes
+            self.totals["retries"] += event.retries
+            self.totals["wait"] += event.wait
+            self.totals["items"] += event.items or 0
+            if event.error is not None:
+                self.errors[event.error] += 1
+            if event.category is not None:
+                category = self.categories[str(event.category)]
+                category[0] += event.wait + event.latency + (event.parse or 0)
+                category[1] += 1
+
+    def summary(self) -> dict:
+        duration = time.perf_counter() - self.start
+        with self.lock:
+            classes = {}
+            for url_class, latency in self.latency.items():
+                latency = sorted(latency)
+                stats = self.classes[url_class]
+                classes[url_class] = {
+                    "requests": len(latency),
+                    "p50": round(latency[len(latency) // 2], 4),
+                    "p95": round(latency[min(len(latency) - 1, int(len(latency) * 0.95))], 4),
+                    "max": round(latency[-1], 4),
+                    "bytes": stats["bytes"],
+                    "parse": round(stats["parse"], 3),
+                    "items": stats["items"],
+                }
+            slowest = sorted(self.categories.items(), key=lambda c: c[1][0], reverse=True)[:SLOWEST_CATEGORIES]
+            return {
+                "name": self.name,
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "duration": round(duration, 3),
+                **self.totals,
+                "wait": round(self.totals["wait"], 3),
+                "requests_per_second": round(self.totals["requests"] / duration, 3) if duration else 0,
+                "items_per_second": round(self.totals["items"] / duration, 3) if duration else 0,
+                "classes": classes,
+                "slowest_categories": [{"category": c, "seconds": round(s, 3), "requests": n} for c, (s, n) in slowest],
+                "errors": dict(self.errors.most_common()),
+            }
+
+    def close(self, report: bool = True) -> Optional[dict]:
+        """
+        寫出摘要，`report` 為 True 時印出與上一次的比較。
+        """
+        if not self.enabled or self.file.closed:
+            return None
+        self.file.close()
+        summary = self.summary()
+
+        baseline = previous_summary(os.path.dirname(self.path), self.path)
+        with open(self.path.removesuffix(".jsonl") + ".summary.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        if report:
+            print(format_report(summary, baseline))
+        return summary
+
+
+def previous_summary(run_dir: str, before: Optional[str] = None) -> Optional[dict]:
+    paths = sorted(glob.glob(os.path.join(run_dir, "*.summary.json")))
+    if before is not None:
+        paths = [p for p in paths if p < before]
+    if not paths:
+        return None
+    with open(paths[-1], "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(current: float, previous: Optional[float], higher_is_better: bool = False) -> str:
+    if not previous:
+        return ""
+    change = (current - previous) / previous
+    worse = -change if higher_is_better else change
+    mark = "  !!" if worse > REGRESSION_THRESHOLD else ""
+    return f"  ({previous:g} -> {change:+.0%}){mark}"
+
+
+def format_report(summary: dict, baseline: Optional[dict] = None) -> str:
+    """
+    摘要的文字報告，有 `baseline` 時附上變化，變差超過 REGRESSION_THRESHOLD 的項目標示 !!。
+    """
+    baseline = baseline or {}
+    base_classes = baseline.get("classes", {})
+    lines = [
+        f"== {summary['name']} {summary['started_at']} ==",
+        f"duration      {summary['duration']:.1f}s" + compare(summary["duration"], baseline.get("duration")),
+        f"requests      {summary.get('requests', 0)} ({summary['requests_per_second']:.2f}/s)"
+        + compare(summary["requests_per_second"], baseline.get("requests_per_second"), higher_is_better=True),
+        f"items         {summary.get('items', 0)} ({summary['items_per_second']:.2f}/s)"
+        + compare(summary["items_per_second"], baseline.get("items_per_second"), higher_is_better=True),
+        f"bytes         {summary.get('bytes', 0) / 1024:.1f} KiB, {summary.get('retries', 0)} retries, "
+        f"{summary.get('wait', 0):.1f}s waiting for the governor",
+    ]
+
+    for url_class, stats in summary["classes"].items():
+        base = base_classes.get(url_class, {})
+        lines.append(
+            f"  {url_class:<24} {stats['requests']:>6} req  p50 {stats['p50'] * 1000:7.1f}ms  "
+            f"p95 {stats['p95'] * 1000:7.1f}ms  parse {stats['parse']:.2f}s" + compare(stats["p95"], base.get("p95"))
+        )
+
+    if summary["slowest_categories"]:
+        lines.append("slowest categories:")
+        for c in summary["slowest_categories"]:
+            lines.append(f"  {c['seconds']:8.2f}s {c['requests']:>4} req  {c['category']}")
+
+    errors = summary["errors"]
+    base_errors = baseline.get("errors", {})
+    lines.append(f"errors        {sum(errors.values())}" + compare(sum(errors.values()), sum(base_errors.values())))
+    for kind, count in errors.items():
+        lines.append(f"  {kind:<24} {count:>6}" + compare(count, base_errors.get(kind)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and os.path.isdir(sys.argv[1]):
+        paths = sorted(glob.glob(os.path.join(sys.argv[1], "*.summary.json")))[-2:][::-1]
+    else:
+        paths = sys.argv[1:3]
+    if not paths:
+        sys.exit("usage: python -m crawler.telemetry <run dir> | <summary.json> [<baseline.summary.json>]")
+
+    summaries = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            summaries.append(json.load(f))
+    print(format_report(summaries[0], summaries[1] if len(summaries) > 1 else None))
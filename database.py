@@ -1,5 +1,21 @@
-from sqlalchemy import BigInteger, Column, Double, Integer, String, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from typing import Optional
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Double,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    SmallInteger,
+    String,
+    UniqueConstraint,
+    create_engine,
+    select,
+)
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
 DB_URL = "sqlite:///./data/product.db"
 
@@ -7,25 +23,329 @@ Base = declarative_base()
 
 engine = create_engine(DB_URL, pool_size=20, max_overflow=0)
 
+# 匯出 / 匯入 CSV 以及 API 回傳時的商品欄位
+PRODUCT_FIELDS = (
+    "id",
+    "pid",
+    "pno",
+    "barcode",
+    "name",
+    "price",
+    "spec",
+    "unit",
+    "price_unit",
+    "channel",
+    "category1",
+    "category2",
+    "category3",
+    "url",
+    "pic_url",
+)
+
+# 全聯商品網址預設的門市 (與 crawler/config.py 的 PX_STORES[0] 相同)
+DEFAULT_SHOP_NO = "025700"
+
+PX_URL_TEMPLATE = (
+    "https://shop.pxgo.com.tw/mweb/#/commodity-details?mweb_user=tourist"
+    "&goodsBarcode={barcode}&goodsId={pid}&goodsNo={pno}&shopNo={shop_no}"
+)
+
+# 商品網址與圖片網址的樣板，每列只存 {part} 的部分
+# {pid}、{pno}、{barcode} 會直接用商品本身的欄位代入，{shop_no} 為全聯門市 (預設 DEFAULT_SHOP_NO)
+# 依序比對，最後一個 "{part}" 用來存放不符合任何樣板的完整網址
+URL_TEMPLATES = (
+    PX_URL_TEMPLATE,
+    "https://online.carrefour.com.tw/zh/{pid}.html",
+    "https://image.pxgo.com.tw/pic/{part}",
+    "https://image.pxgo.com.tw/pxmart-pic/{part}",
+    "https://online.carrefour.com.tw/dw/image/v2/BFHC_PRD/on/demandware.static/-/Sites-carrefour-tw-m-inner/default/{part}",
+    "{part}",
+)
+
+
+def split_url(url: str, **fields) -> tuple[str, str]:
+    """
+    找出符合網址的樣板，回傳 (樣板, 可變部分)。
+    """
+    for template in URL_TEMPLATES:
+        prefix, placeholder, suffix = template.partition("{part}")
+        prefix, suffix = prefix.format(**fields), suffix.format(**fields)
+        if not placeholder:
+            if url == prefix:
+                return template, ""
+        elif url.startswith(prefix) and url.endswith(suffix) and len(url) >= len(prefix) + len(suffix):
+            return template, url[len(prefix) : len(url) - len(suffix)]
+    raise ValueError(f"No template matches {url!r}")
+
+
+class Channel(Base):
+    __tablename__ = "channels"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20), unique=True, nullable=False)
+
+    @classmethod
+    def id_of(cls, name: str):
+        return select(cls.id).where(cls.name == name).scalar_subquery()
+
+
+class CategoryPath(Base):
+    __tablename__ = "category_paths"
+    __table_args__ = (UniqueConstraint("category1", "category2", "category3"),)
+
+    id = Column(Integer, primary_key=True)
+    category1 = Column(String(20), nullable=False)
+    category2 = Column(String(20), nullable=False)
+    category3 = Column(String(20), nullable=False)
+
+
+class Unit(Base):
+    __tablename__ = "units"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(10), unique=True, nullable=False)
+
+
+class UrlTemplate(Base):
+    __tablename__ = "url_templates"
+
+    id = Column(Integer, primary_key=True)
+    template = Column(String(300), unique=True, nullable=False)
+
 
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (
+        Index("ix_products_category_price_unit", "category_id", "price_unit"),
+        Index("ix_products_channel_price_unit", "channel_id", "price_unit"),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
-    pid = Column(BigInteger)
+    id = Column(Integer, primary_key=True)
+    pid = Column(BigInteger, index=True)
     pno = Column(String(20), nullable=True)
     barcode = Column(String(20), nullable=True)
     name = Column(String(100))
     price = Column(Integer)
     spec = Column(Double)
-    unit = Column(String(10))
-    price_unit = Column(Double)
-    channel = Column(String(20))
-    category1 = Column(String(20))
-    category2 = Column(String(20))
-    category3 = Column(String(20))
-    url = Column(String(300))
-    pic_url = Column(String(300))
+    unit_id = Column(SmallInteger, ForeignKey("units.id"), nullable=False)
+    price_unit = Column(Double, index=True)
+    channel_id = Column(SmallInteger, ForeignKey("channels.id"), nullable=False)
+    category_id = Column(SmallInteger, ForeignKey("category_paths.id"), nullable=False)
+    url_template_id = Column(SmallInteger, ForeignKey("url_templates.id"), nullable=False)
+    url_part = Column(String(300))
+    pic_url_template_id = Column(SmallInteger, ForeignKey("url_templates.id"), nullable=False)
+    pic_url_part = Column(String(300))
+
+    # 維度表都很小，直接 join 進來
+    _unit = relationship(Unit, lazy="joined", innerjoin=True)
+    _channel = relationship(Channel, lazy="joined", innerjoin=True)
+    _category = relationship(CategoryPath, lazy="joined", innerjoin=True)
+    _url_template = relationship(UrlTemplate, foreign_keys=[url_template_id], lazy="joined", innerjoin=True)
+    _pic_url_template = relationship(UrlTemplate, foreign_keys=[pic_url_template_id], lazy="joined", innerjoin=True)
+
+    @property
+    def unit(self) -> str:
+        return self._unit.name
+
+    @property
+    def channel(self) -> str:
+        return self._channel.name
+
+    @property
+    def category1(self) -> str:
+        return self._category.category1
+
+    @property
+    def category2(self) -> str:
+        return self._category.category2
+
+    @property
+    def category3(self) -> str:
+        return self._category.category3
+
+    def _render(self, template: UrlTemplate, part: str, shop_no: str = DEFAULT_SHOP_NO) -> str:
+        return template.template.format(pid=self.pid, pno=self.pno, barcode=self.barcode, shop_no=shop_no, part=part)
+
+    @property
+    def url(self) -> str:
+        return self._render(self._url_template, self.url_part)
+
+    def url_for(self, shop_no: str) -> str:
+        """
+        指定全聯門市的商品網址，其他通路商與 `url` 相同。
+        """
+        return self._render(self._url_template, self.url_part, shop_no)
+
+    @property
+    def pic_url(self) -> str:
+        return self._render(self._pic_url_template, self.pic_url_part)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in PRODUCT_FIELDS}
+
+    @classmethod
+    def from_dict(cls, session, data: dict) -> "Product":
+        """
+        從未正規化的欄位 (channel、category1 ...、url) 建立商品，
+        需要的維度資料會自動新增。
+        """
+        fields = {"pid": data["pid"], "pno": data["pno"], "barcode": data["barcode"], "shop_no": DEFAULT_SHOP_NO}
+        url_template, url_part = split_url(data["url"], **fields)
+        pic_url_template, pic_url_part = split_url(data["pic_url"], **fields)
+
+        return cls(
+            id=data.get("id") or None,
+            pid=data["pid"],
+            pno=data["pno"],
+            barcode=data["barcode"],
+            name=data["name"],
+            price=data["price"],
+            spec=data["spec"],
+            price_unit=data["price_unit"],
+            _unit=get_or_create(session, Unit, name=data["unit"]),
+            _channel=get_or_create(session, Channel, name=data["channel"]),
+            _category=get_or_create(
+                session,
+                CategoryPath,
+                category1=data["category1"],
+                category2=data["category2"],
+                category3=data["category3"],
+            ),
+            _url_template=get_or_create(session, UrlTemplate, template=url_template),
+            url_part=url_part,
+            _pic_url_template=get_or_create(session, UrlTemplate, template=pic_url_template),
+            pic_url_part=pic_url_part,
+        )
+
+
+class Store(Base):
+    __tablename__ = "stores"
+
+    id = Column(Integer, primary_key=True)
+    shop_no = Column(String(10), unique=True, nullable=False)
+
+    @classmethod
+    def id_of(cls, shop_no: str):
+        return select(cls.id).where(cls.shop_no == shop_no).scalar_subquery()
+
+
+class StorePrice(Base):
+    """
+    各門市的商品價格，商品本身的 `price` 是預設門市的價格。
+    """
+
+    __tablename__ = "store_prices"
+    __table_args__ = (
+        Index("ix_store_prices_store_price_unit", "store_id", "price_unit"),
+        {"sqlite_with_rowid": False},
+    )
+
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    store_id = Column(SmallInteger, ForeignKey("stores.id"), primary_key=True)
+    price = Column(Integer, nullable=False)
+    price_unit = Column(Double, nullable=False)
+
+
+class PriceHistory(Base):
+    """
+    商品價格歷史，每個商品每個月一列，
+    `changes` 依序存放這個月每次價格變動的 (日, 價格)，
+    格式見 history.py。
+    """
+
+    __tablename__ = "price_history"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    month = Column(Integer, primary_key=True)  # year * 12 + (month - 1)
+    changes = Column(LargeBinary, nullable=False)
+
+
+class Generation(Base):
+    """
+    每次執行 update.py 的更新批次，編號遞增。
+    """
+
+    __tablename__ = "generations"
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class ProductChange(Base):
+    """
+    每個批次中有變動的商品。
+    商品可能已被刪除，所以 pid 與通路商另外存一份。
+    """
+
+    __tablename__ = "product_changes"
+    __table_args__ = (Index("ix_product_changes_generation", "generation_id", "id"),)
+
+    id = Column(Integer, primary_key=True)
+    generation_id = Column(Integer, ForeignKey("generations.id"), nullable=False)
+    product_id = Column(Integer, nullable=False)
+    pid = Column(BigInteger, nullable=False)
+    channel_id = Column(SmallInteger, ForeignKey("channels.id"), nullable=False)
+    op = Column(String(10), nullable=False)  # "new"、"price"、"spec" 或 "removed"
+    price = Column(Integer, nullable=True)
+    price_unit = Column(Double, nullable=True)
+    spec = Column(Double, nullable=True)
+    unit_id = Column(SmallInteger, ForeignKey("units.id"), nullable=True)
+
+    _channel = relationship(Channel, lazy="joined", innerjoin=True)
+    _unit = relationship(Unit, lazy="joined")
+
+    @property
+    def channel(self) -> str:
+        return self._channel.name
+
+    @property
+    def unit(self) -> Optional[str]:
+        return self._unit.name if self._unit is not None else None
+
+
+class UpdateRun(Base):
+    """
+    排程更新 (scheduler.py) 的一次執行，每個通路商各自獨立。
+    """
+
+    __tablename__ = "update_runs"
+    __table_args__ = (Index("ix_update_runs_channel", "channel", "id"),)
+
+    id = Column(Integer, primary_key=True)
+    channel = Column(String(10), nullable=False)
+    generation_id = Column(Integer, ForeignKey("generations.id"), nullable=False)
+    status = Column(String(10), nullable=False)  # "planning"、"running"、"done" 或 "failed"
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class WorkUnit(Base):
+    """
+    一次更新中的工作單位 (一個分類)，完成時與該分類的價格在同一個 transaction 中寫入，
+    中斷後可以從沒完成的單位繼續。
+    """
+
+    __tablename__ = "work_units"
+
+    run_id = Column(Integer, ForeignKey("update_runs.id"), primary_key=True)
+    key = Column(String(50), primary_key=True)
+    status = Column(String(10), nullable=False)  # "pending"、"done" 或 "failed"
+    attempts = Column(Integer, nullable=False, default=0)
+    items = Column(Integer, nullable=False, default=0)
+    failed_items = Column(Integer, nullable=False, default=0)  # 單位完成但個別商品失敗的數量
+    error = Column(String(300), nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+
+def get_or_create(session, model, **kwargs):
+    instance = session.query(model).filter_by(**kwargs).one_or_none()
+    if instance is None:
+        instance = model(**kwargs)
+        session.add(instance)
+        session.flush()
+    return instance
 
 
 def create_table():
@@ -0,0 +1,183 @@
+"""
+商品價格歷史
+
+價格只有在變動時才會記錄 (change-compressed)，並依月份分桶：
+每個商品每個月一列，`changes` 是連續的 (日: uint8, 價格: int32) 紀錄，每筆 5 bytes。
+查詢一段期間時只會讀取期間內的月份，再加上期間開始前最後一次的價格。
+`price_unit` 不另外儲存，讀取時用商品目前的 `spec` 換算。
+"""
+
+from __future__ import annotations
+
+import struct
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, select
+
+from database import PriceHistory
+
+ENTRY = struct.Struct("<Bi")
+
+# 一次查詢最新價格的商品數，避免 SQL 參數過多
+CHUNK_SIZE = 500
+
+
+def month_key(d: date) -> int:
+    return d.year * 12 + d.month - 1
+
+
+def month_start(key: int) -> date:
+    return date(key // 12, key % 12 + 1, 1)
+
+
+def encode(entries: List[Tuple[int, int]]) -> bytes:
+    return b"".join(ENTRY.pack(day, price) for day, price in entries)
+
+
+def decode(blob: bytes) -> List[Tuple[int, int]]:
+    return list(ENTRY.iter_unpack(blob))
+
+
+def iter_changes(rows: Iterable[PriceHistory]) -> Iterable[Tuple[date, int]]:
+    for row in rows:
+        first = month_start(row.month)
+        for day, price in decode(row.changes):
+            yield first.replace(day=day), price
+
+
+def latest_rows(session, product_ids: Iterable[int]) -> Dict[int, PriceHistory]:
+    """
+    取得每個商品最新一個月的歷史紀錄。
+    """
+    product_ids = list(product_ids)
+    rows = {}
+    for i in range(0, len(product_ids), CHUNK_SIZE):
+        chunk = product_ids[i : i + CHUNK_SIZE]
+        latest = (
+            select(PriceHistory.product_id, func.max(PriceHistory.month).label("month"))
+            .where(PriceHistory.product_id.in_(chunk))
+            .group_by(PriceHistory.product_id)
+            .subquery()
+        )
+        query = session.query(PriceHistory).join(
+            latest,
+            and_(PriceHistory.product_id == latest.c.product_id, PriceHistory.month == latest.c.month),
+        )
+        rows.update((row.product_id, row) for row in query)
+    return rows
+
+
+def previous_row(session, product_id: int, month: int) -> Optional[PriceHistory]:
+    """
+    取得商品在 `month` 之前最後一個月的歷史紀錄。
+    """
+    return (
+        session.query(PriceHistory)
+        .filter(PriceHistory.product_id == product_id, PriceHistory.month < month)
+        .order_by(PriceHistory.month.desc())
+        .first()
+    )
+
+
+def record_prices(session, prices: Dict[int, int], today: Optional[date] = None) -> int:
+    """
+    在更新結束時一次寫入這次的價格 ({product_id: price})，
+    只有價格有變動 (或第一次出現) 的商品才會新增紀錄。
+    同一天更新多次時只保留最後的價格。
+    回傳新增的紀錄數。
+    """
+    today = today or date.today()
+    key = month_key(today)
+    latest = latest_rows(session, prices.keys())
+
+    count = 0
+    for product_id, price in prices.items():
+        row = latest.get(product_id)
+        if row is None or row.month != key:
+            if row is not None and decode(row.changes)[-1][1] == price:
+                continue
+            session.add(PriceHistory(product_id=product_id, month=key, changes=encode([(today.day, price)])))
+            count += 1
+            continue
+
+        entries = decode(row.changes)
+        last_day, last_price = entries[-1]
+        if last_price == price:
+            continue
+        if last_day == today.day:
+            entries.pop()
+            if not entries:
+                # 這個月只有今天的紀錄，改回上個月最後的價格時整列都不需要了
+                previous = previous_row(session, product_id, key)
+                if previous is not None and decode(previous.changes)[-1][1] == price:
+                    session.delete(row)
+                    continue
+            elif entries[-1][1] == price:
+                row.changes = encode(entries)
+                continue
+        else:
+            count += 1
+        entries.append((today.day, price))
+        row.changes = encode(entries)
+
+    return count
+
+
+def price_history(session, product_id: int, start: date, end: date) -> List[Tuple[date, int]]:
+    """
+    回傳期間內的價格變動，
+    若期間開始前已有價格，第一筆會是 (start, 當時的價格)。
+    """
+    rows = (
+        session.query(PriceHistory)
+        .filter(PriceHistory.product_id == product_id)
+        .filter(PriceHistory.month.between(month_key(start), month_key(end)))
+        .order_by(PriceHistory.month)
+        .all()
+    )
+    before = (
+        session.query(PriceHistory)
+        .filter(PriceHistory.product_id == product_id)
+        .filter(PriceHistory.month < month_key(start))
+        .order_by(PriceHistory.month.desc())
+        .first()
+    )
+    if before is not None:
+        rows.insert(0, before)
+
+    opening = None
+    changes = []
+    for day, price in iter_changes(rows):
+        if day < start:
+            opening = price
+        elif day <= end:
+            changes.append((day, price))
+
+    if opening is not None and (not changes or changes[0][0] != start):
+        changes.insert(0, (start, opening))
+    return changes
+
+
+def downsample(changes: List[Tuple[date, int]], start: date, end: date, points: int) -> List[dict]:
+    """
+    將期間平均切成 `points` 段，每段回傳段落結束時的價格與段落內的最低、最高價。
+    價格是階梯函數: 兩次變動之間維持前一次的價格。
+    還沒有價格紀錄的段落會被略過。
+    """
+    span = (end - start).days + 1
+    points = min(points, span)
+
+    result = []
+    i, current = 0, None
+    for n in range(points):
+        last = start + timedelta(days=(n + 1) * span // points - 1)
+        seen = [] if current is None else [current]
+        while i < len(changes) and changes[i][0] <= last:
+            current = changes[i][1]
+            seen.append(current)
+            i += 1
+        if current is None:
+            continue
+        result.append({"date": last, "price": current, "min_price": min(seen), "max_price": max(seen)})
+    return result
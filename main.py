@@ -1,20 +1,110 @@
 from __future__ import annotations
 
+import asyncio
 import json
-from typing import List, Optional
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional
 
 import uvicorn
-from fastapi import APIRouter, FastAPI, Query
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 from pydantic import BaseModel
+from sqlalchemy import event, select
+
+from admission import AdmissionController, Rejected, client_id, estimate_cost
+from changes import latest_generation
+from database import (
+    DB_URL,
+    DEFAULT_SHOP_NO,
+    CategoryPath,
+    Channel,
+    Product,
+    ProductChange,
+    Store,
+    StorePrice,
+    create_session,
+    create_table,
+    engine,
+)
+from history import downsample, price_history
+from snapshot import SnapshotReloader
+from update_status import update_status
+
+# `/products` 的查詢後端: "sql" 直接查資料庫，"snapshot" 使用記憶體中的商品快照
+PRODUCTS_BACKEND = os.environ.get("PRICESCOUT_BACKEND", "sql")
+
+# 具代表性的 /products 查詢: 分類瀏覽、通路商、關鍵字、深分頁
+# 啟動時用來預熱，benchmark.py 也用它們測量延遲
+PRODUCT_QUERIES = [
+    {},
+    {"category1": "油米雜糧"},
+    {"category1": "油米雜糧", "category2": "麵類", "category3": "泡麵"},
+    {"channel": "全聯"},
+    {"channel": "家樂福", "category1": "生鮮"},
+    {"query": "牛奶"},
+    {"query": "麵 -辣"},
+    {"category1": "調味料、罐頭", "page": 20, "limit": 20},
+]
+
+# 每個新連線建立時先讀一次 /products 會用到的頁面: 維度表、products 的資料頁 (關鍵字查詢會掃過)
+# 以及分類 / 通路商 / 排序用的索引
+WARM_UP_QUERIES = (
+    "SELECT * FROM category_paths",
+    "SELECT * FROM channels",
+    "SELECT * FROM units",
+    "SELECT * FROM url_templates",
+    "SELECT * FROM stores",
+    "SELECT count(name) FROM products",
+    "SELECT count(*) FROM products INDEXED BY ix_products_category_price_unit",
+    "SELECT count(*) FROM products INDEXED BY ix_products_channel_price_unit",
+    "SELECT count(*) FROM products INDEXED BY ix_products_price_unit",
+)
+
+
+def warm_connection(dbapi_connection, connection_record) -> None:
+    """
+    每個連線都有自己的 page cache，在連線建立時各自讀入，不用一次佔住連線池中所有的連線。
+    資料表或索引還不存在時略過。由 warm_up() 註冊，import main 的 benchmark 不會預熱連線。
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for sql in WARM_UP_QUERIES:
+            try:
+                cursor.execute(sql).fetchall()
+            except sqlite3.Error:
+                pass
+    finally:
+        cursor.close()
+
+
+# 建立尚未存在的資料表 (例如 price_history)
+create_table()
+
+
+# 預熱的進度，/readyz 會回傳
+readiness = {"status": "warming up", "warm_up_seconds": None, "steps": {}, "error": None}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 在背景預熱，期間 /healthz 可以回應，/readyz 則要等預熱完成
+    task = asyncio.create_task(asyncio.to_thread(warm_up))
+    yield
+    task.cancel()
 
-from database import Product, create_session
 
 app = FastAPI(
     title="PriceScout API",
     summary="超市商品比價網 後端資料庫 API",
     version="1.0",
+    lifespan=lifespan,
 )
 
 
@@ -26,6 +116,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# `/products` 的准入控制，見 admission.py
+admission = AdmissionController()
+
+
+@app.exception_handler(Rejected)
+async def rejected_handler(request: Request, exc: Rejected):
+    return JSONResponse({"detail": exc.reason}, status_code=exc.status, headers=exc.headers)
+
+
 api = APIRouter()
 
 
@@ -76,6 +177,123 @@ async def healthz():
     return {"message": "alive"}
 
 
+class Readiness(BaseModel):
+    status: str
+    warm_up_seconds: Optional[float] = None
+    steps: Dict[str, float] = {}
+    error: Optional[str] = None
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "status": "ready",
+                    "warm_up_seconds": 0.412,
+                    "steps": {"database_file": 0.003, "connections": 0.004, "products": 0.121, "categories": 0.007},
+                    "error": None,
+                }
+            ]
+        }
+    }
+
+
+@api.get("/readyz", summary="是否可以開始接收流量", response_model=Readiness)
+async def readyz(response: Response):
+    """
+    啟動後會先預熱資料庫連線、SQLite 的 page cache、常見的商品查詢與商品分類，
+    完成前回傳 503 (`status` 為 "warming up")，預熱失敗時也是 503 (`status` 為 "failed")。
+    `steps` 是各步驟花費的秒數。
+    """
+    if readiness["status"] != "ready":
+        response.status_code = 503
+    return readiness
+
+
+class AdmissionStats(BaseModel):
+    enabled: bool
+    in_flight: int
+    queue_depth: int
+    clients: int
+    requests: int
+    admitted: int
+    queued: int
+    rejected: Dict[str, int]
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "enabled": True,
+                    "in_flight": 2,
+                    "queue_depth": 0,
+                    "clients": 18,
+                    "requests": 1532,
+                    "admitted": 1490,
+                    "queued": 37,
+                    "rejected": {"too_expensive": 3, "rate_limited": 39, "queue_full": 0, "queue_timeout": 0},
+                }
+            ]
+        }
+    }
+
+
+@api.get("/admission", summary="查詢的准入控制統計", response_model=AdmissionStats)
+async def admission_stats():
+    """
+    `/products` 的准入控制統計 (啟動後累計)：
+    `queued` 是曾經排隊的請求數，`rejected` 是各原因被拒絕的請求數，
+    `in_flight` 與 `queue_depth` 是目前執行中與排隊中的請求數。
+    """
+    return admission.stats()
+
+
+def warm_up() -> None:
+    steps = {}
+    start = time.perf_counter()
+    try:
+        # 資料庫檔案讀進 OS 的檔案快取
+        t = time.perf_counter()
+        with open(DB_URL.removeprefix("sqlite:///"), "rb") as f:
+            while f.read(1 << 20):
+                pass
+        steps["database_file"] = time.perf_counter() - t
+
+        # 預先建立同時查詢數上限 (admission.max_concurrent) 個連線，建立時由 warm_connection 預熱，
+        # 其他連線在需要時才建立並預熱
+        t = time.perf_counter()
+        if not event.contains(engine, "connect", warm_connection):
+            event.listen(engine, "connect", warm_connection)
+            # 連線池中已經有的連線 (例如建立資料表時用到的) 沒有預熱過，關掉讓之後的連線重新建立
+            engine.dispose()
+        connections = []
+        try:
+            for _ in range(min(admission.max_concurrent, engine.pool.size())):
+                connections.append(engine.connect())
+        finally:
+            for conn in connections:
+                conn.close()
+        steps["connections"] = time.perf_counter() - t
+
+        # 編譯並快取常見查詢的 SQL，同時讀入索引的頁面
+        t = time.perf_counter()
+        for params in PRODUCT_QUERIES:
+            query_products(**params)
+            if snapshots is not None:
+                snapshots.current().query(**params)
+        steps["products"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        category_tree()
+        steps["categories"] = time.perf_counter() - t
+    except Exception as e:
+        readiness.update(status="failed", error=repr(e))
+        return
+    finally:
+        readiness["steps"] = {step: round(seconds, 4) for step, seconds in steps.items()}
+        readiness["warm_up_seconds"] = round(time.perf_counter() - start, 4)
+    readiness["status"] = "ready"
+
+
 ########################################################################
 
 
@@ -116,22 +334,7 @@ async def subcategory(
     若沒有指定分類，則回傳所有第一層分類。
     若找不到指定的分類，則回傳空陣列。
     """
-
-    with open("data/categories.json", "r", encoding="utf-8") as f:
-        categories = json.load(f)
-
-    cats = {}
-
-    for cat in categories["category"]:
-        cat1 = cat["name"]
-        cats[cat1] = {}
-        for cat in cat["children"]:
-            cat2 = cat["name"]
-            cats[cat1][cat2] = {}
-            if "children" in cat:
-                for cat in cat["children"]:
-                    cat3 = cat["name"]
-                    cats[cat1][cat2][cat3] = {}
+    cats = category_tree()
 
     try:
         if category3:
@@ -150,6 +353,29 @@ async def subcategory(
     return ret
 
 
+@lru_cache(maxsize=1)
+def category_tree() -> dict:
+    """
+    商品分類 {第一層: {第二層: {第三層: {}}}}，只會讀取一次，更新 data/categories.json 後要重新啟動。
+    """
+    with open("data/categories.json", "r", encoding="utf-8") as f:
+        categories = json.load(f)
+
+    cats = {}
+
+    for cat in categories["category"]:
+        cat1 = cat["name"]
+        cats[cat1] = {}
+        for cat in cat["children"]:
+            cat2 = cat["name"]
+            cats[cat1][cat2] = {}
+            if "children" in cat:
+                for cat in cat["children"]:
+                    cat3 = cat["name"]
+                    cats[cat1][cat2][cat3] = {}
+    return cats
+
+
 ########################################################################
 
 
@@ -257,52 +483,372 @@ class ProductsResponse(BaseModel):
 
 @api.get("/products", tags=["產品"], summary="取得商品列表", response_model=ProductsResponse)
 async def products(
+    request: Request,
     category1: Optional[str] = Query(None, description="指定商品的第一層分類"),
     category2: Optional[str] = Query(None, description="指定商品的第二層分類"),
     category3: Optional[str] = Query(None, description="指定商品的第三層分類"),
     channel: Optional[str] = Query(None, description="指定商品的通路商"),
+    store: Optional[str] = Query(None, description="指定全聯門市編號，回傳該門市的價格"),
     query: Optional[str] = Query(None, description="查詢商品名稱"),
     page: Optional[int] = Query(1, ge=1, description="查詢第幾頁"),
-    limit: Optional[int] = Query(10, ge=1, description="每頁顯示幾筆資料"),
+    limit: Optional[int] = Query(10, ge=1, le=1000, description="每頁顯示幾筆資料"),
 ):
     """
     根據指定的商品分類、通路商、查詢字串，回傳商品列表。
     查詢字串可以用空格分隔多個關鍵字，也可以用 "-" 來排除某個關鍵字。
+    指定門市時只會回傳該門市有販售的商品，價格也會換成該門市的價格。
     為了避免資料量過大，預設每次只回傳 10 筆資料。
+
+    查詢會依成本 (關鍵字數、每頁筆數、頁數) 做流量控制，
+    單次查詢太大時回傳 400，查詢太頻繁或伺服器忙碌時回傳 429 (附 Retry-After)。
     """
     # print(category1, category2, category3, page, limit)
 
+    # 快照只有預設價格，指定門市時改查資料庫
+    snapshot = snapshots.current() if snapshots is not None else None
+    use_snapshot = snapshot is not None and not store
+    cost = estimate_cost(category1, category2, category3, channel, query, page, limit, store, use_snapshot)
+    async with admission.admit(client_id(request.headers, request.client and request.client.host), cost):
+        if use_snapshot:
+            total_count, products = snapshot.query(category1, category2, category3, channel, query, page, limit)
+        else:
+            total_count, products = await asyncio.to_thread(
+                query_products, category1, category2, category3, channel, query, page, limit, store
+            )
+
+    return {
+        "total_count": total_count,
+        "page": page,
+        "limit": limit,
+        "products": products,
+    }
+
+
+def query_products(
+    category1: Optional[str] = None,
+    category2: Optional[str] = None,
+    category3: Optional[str] = None,
+    channel: Optional[str] = None,
+    query: Optional[str] = None,
+    page: int = 1,
+    limit: int = 10,
+    store: Optional[str] = None,
+):
     session = create_session()
-    products = session.query(Product)
-
-    if category1:
-        products = products.filter(Product.category1 == category1)
-    if category2:
-        products = products.filter(Product.category2 == category2)
-    if category3:
-        products = products.filter(Product.category3 == category3)
+    # 預設門市的價格就是商品本身的價格，不另外存在 store_prices
+    store_prices = store is not None and store != DEFAULT_SHOP_NO
+    if store_prices:
+        products = session.query(Product, StorePrice.price, StorePrice.price_unit).join(
+            StorePrice, StorePrice.product_id == Product.id
+        )
+        products = products.filter(StorePrice.store_id == Store.id_of(store))
+        price_unit = StorePrice.price_unit
+    else:
+        products = session.query(Product)
+        if store:
+            products = products.filter(Product.channel_id == Channel.id_of("全聯"))
+        price_unit = Product.price_unit
+
+    if category1 or category2 or category3:
+        categories = select(CategoryPath.id)
+        if category1:
+            categories = categories.where(CategoryPath.category1 == category1)
+        if category2:
+            categories = categories.where(CategoryPath.category2 == category2)
+        if category3:
+            categories = categories.where(CategoryPath.category3 == category3)
+        products = products.filter(Product.category_id.in_(categories))
     if channel:
-        products = products.filter(Product.channel == channel)
+        products = products.filter(Product.channel_id == Channel.id_of(channel))
     if query:
         for keyword in query.split():
             if keyword.startswith("-"):
                 keyword = keyword[1:]
-                products = products.filter(~Product.name.contains(keyword))
+                products = products.filter(~Product.name.contains(keyword, autoescape=True))
             else:
-                products = products.filter(Product.name.contains(keyword))
+                products = products.filter(Product.name.contains(keyword, autoescape=True))
+
+    try:
+        total_count = products.count()
+        products = products.order_by(price_unit.asc(), Product.id.asc())
+        products = products.offset((page - 1) * limit).limit(limit)
+        if store_prices:
+            return total_count, [
+                {**p.to_dict(), "price": price, "price_unit": pu, "url": p.url_for(store)} for p, price, pu in products
+            ]
+        return total_count, products.all()
+    finally:
+        session.close()
+
+
+# 快照在 import 時就載入，fork 出來的 worker 可以 copy-on-write 共用，重建後各 worker 會各自重新載入
+snapshots = SnapshotReloader() if PRODUCTS_BACKEND == "snapshot" else None
+
+
+class PricePoint(BaseModel):
+    date: date
+    price: int
+    min_price: int
+    max_price: int
+    price_unit: float
+
+
+class PriceHistoryResponse(BaseModel):
+    pid: int
+    start: date
+    end: date
+    lowest_price: Optional[int] = None
+    points: List[PricePoint]
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "pid": 1,
+                    "start": "2024-12-01",
+                    "end": "2024-12-30",
+                    "lowest_price": 89,
+                    "points": [
+                        {"date": "2024-12-15", "price": 99, "min_price": 99, "max_price": 109, "price_unit": 0.99},
+                        {"date": "2024-12-30", "price": 89, "min_price": 89, "max_price": 99, "price_unit": 0.89},
+                    ],
+                }
+            ]
+        }
+    }
+
+
+@api.get(
+    "/products/{pid}/history",
+    tags=["產品"],
+    summary="取得商品價格歷史",
+    response_model=PriceHistoryResponse,
+)
+async def product_history(
+    pid: int,
+    days: int = Query(30, ge=1, le=3660, description="查詢最近幾天的價格"),
+    points: int = Query(30, ge=1, le=366, description="最多回傳幾個資料點"),
+):
+    """
+    回傳商品最近一段期間的價格變化。
+    期間會平均切成 `points` 段，每段回傳段落結束時的價格，以及段落內的最低、最高價。
+    `lowest_price` 是整段期間內的最低價，例如 `days=30` 即為 30 天內最低價。
+    """
+    end = date.today()
+    start = end - timedelta(days=days - 1)
+
+    session = create_session()
+    try:
+        product = session.query(Product).filter(Product.pid == pid).first()
+        if product is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+        changes = price_history(session, product.id, start, end)
+        spec = product.spec
+    finally:
+        session.close()
+
+    sampled = downsample(changes, start, end, points)
+    for point in sampled:
+        point["price_unit"] = round(point["price"] / spec, 4)
+
+    return {
+        "pid": pid,
+        "start": start,
+        "end": end,
+        "lowest_price": min((p for _, p in changes), default=None),
+        "points": sampled,
+    }
+
+
+class ProductChangeModel(BaseModel):
+    generation: int
+    op: str
+    pid: int
+    channel: str
+    price: Optional[int] = None
+    price_unit: Optional[float] = None
+    spec: Optional[float] = None
+    unit: Optional[str] = None
+    product: Optional[ProductModel] = None
+
+
+class ProductChangesResponse(BaseModel):
+    since: int
+    generation: int
+    total_count: int
+    page: int = 1
+    limit: int = 100
+    changes: List[ProductChangeModel]
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "since": 3,
+                    "generation": 4,
+                    "total_count": 2,
+                    "page": 1,
+                    "limit": 100,
+                    "changes": [
+                        {
+                            "generation": 4,
+                            "op": "price",
+                            "pid": 1,
+                            "channel": "全聯",
+                            "price": 89,
+                            "price_unit": 0.89,
+                            "spec": 100,
+                            "unit": "g",
+                        },
+                        {
+                            "generation": 4,
+                            "op": "spec",
+                            "pid": 3,
+                            "channel": "家樂福",
+                            "price": 110,
+                            "price_unit": 13.75,
+                            "spec": 8,
+                            "unit": "入",
+                        },
+                        {"generation": 4, "op": "removed", "pid": 2, "channel": "家樂福"},
+                    ],
+                }
+            ]
+        }
+    }
+
 
-    total_count = products.count()
-    products = products.order_by(Product.price_unit.asc())
-    products = products.offset((page - 1) * limit).limit(limit)
+@api.get(
+    "/products/changes",
+    tags=["產品"],
+    summary="取得商品異動",
+    response_model=ProductChangesResponse,
+    response_model_exclude_none=True,
+)
+async def product_changes(
+    since: int = Query(0, ge=0, description="上次同步到的批次編號"),
+    until: Optional[int] = Query(None, ge=0, description="同步到哪個批次，第 2 頁之後請帶第 1 頁回傳的 `generation`"),
+    page: Optional[int] = Query(1, ge=1, description="查詢第幾頁"),
+    limit: Optional[int] = Query(100, ge=1, le=1000, description="每頁顯示幾筆資料"),
+):
+    """
+    回傳批次 `since` 之後的商品異動，依發生順序排列。
+    `op` 為 `new` (新增，附上完整的 `product`)、`price` (價格變動)、
+    `spec` (價格不變，規格或單位重新換算) 或 `removed` (刪除)。
+    客戶端依序套用後，下次改用回傳的 `generation` 作為 `since`。
+
+    回傳的是批次 `since` 之後到 `generation` 為止的異動。不同通路商的批次會同時進行，異動的順序會交錯，
+    翻頁時如果有批次剛好完成，範圍就會改變，因此第 2 頁之後要把第 1 頁回傳的 `generation` 帶在 `until`。
+    `until` 超過目前可以同步到的批次時回傳 400。
+    """
+    session = create_session()
+    try:
+        generation = latest_generation(session)
+        if until is not None:
+            if until > generation:
+                raise HTTPException(status_code=400, detail=f"Generation {until} is not finished yet")
+            generation = until
+        changes = session.query(ProductChange).filter(
+            ProductChange.generation_id > since,
+            ProductChange.generation_id <= generation,
+        )
+        total_count = changes.count()
+        changes = changes.order_by(ProductChange.id).offset((page - 1) * limit).limit(limit).all()
+
+        new_ids = [c.product_id for c in changes if c.op == "new"]
+        products = {p.id: p for p in session.query(Product).filter(Product.id.in_(new_ids))} if new_ids else {}
+
+        items = []
+        for c in changes:
+            item = {
+                "generation": c.generation_id,
+                "op": c.op,
+                "pid": c.pid,
+                "channel": c.channel,
+                "price": c.price,
+                "price_unit": c.price_unit,
+                "spec": c.spec,
+                "unit": c.unit,
+            }
+            if c.product_id in products:
+                item["product"] = products[c.product_id].to_dict()
+            items.append(item)
+    finally:
+        session.close()
 
     return {
+        "since": since,
+        "generation": generation,
         "total_count": total_count,
         "page": page,
         "limit": limit,
-        "products": products.all(),
+        "changes": items,
     }
 
 
+########################################################################
+
+
+class UpdateStatus(BaseModel):
+    channel: str
+    run_id: int
+    generation: int
+    status: str
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    next_run_at: datetime
+    pending: int
+    done: int
+    failed: int
+    items: int
+    failed_items: int
+    last_error: Optional[str] = None
+
+
+class UpdateStatusResponse(BaseModel):
+    channels: List[UpdateStatus]
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "channels": [
+                        {
+                            "channel": "px",
+                            "run_id": 3,
+                            "generation": 5,
+                            "status": "running",
+                            "started_at": "2024-12-24T03:00:00",
+                            "finished_at": None,
+                            "next_run_at": "2024-12-25T03:00:00",
+                            "pending": 120,
+                            "done": 180,
+                            "failed": 0,
+                            "items": 9000,
+                            "failed_items": 0,
+                            "last_error": None,
+                        }
+                    ]
+                }
+            ]
+        }
+    }
+
+
+@api.get("/update/status", tags=["資料更新"], summary="資料更新進度", response_model=UpdateStatusResponse)
+async def update_progress():
+    """
+    各通路商最近一次排程更新 (scheduler.py) 的進度，
+    `pending`、`done`、`failed` 為各狀態的工作單位 (分類) 數量，`items` 為已更新的商品數，
+    `failed_items` 為已完成的單位中失敗的商品數 (例如家樂福個別商品頁抓取失敗)。
+    """
+    session = create_session()
+    try:
+        return {"channels": update_status(session)}
+    finally:
+        session.close()
+
+
 ########################################################################
 
 app.include_router(api, prefix="/api/v1")
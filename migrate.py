@@ -0,0 +1,82 @@
+"""
+將舊版 (未正規化) 的 `products` 資料表轉換成目前的資料表結構
+
+    python migrate.py
+"""
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import Session
+
+from database import Base, Product, engine
+
+LEGACY_TABLE = "products_legacy"
+
+
+def is_legacy() -> bool:
+    """
+    `products` 還是舊的資料表結構，或是有之前沒完成的轉換留下的 `products_legacy`。
+    """
+    inspector = inspect(engine)
+    if inspector.has_table(LEGACY_TABLE):
+        return True
+    columns = {c["name"] for c in inspector.get_columns("products")}
+    return "channel" in columns
+
+
+def transactional_engine():
+    """
+    與 database.engine 相同的資料庫，但 DDL 也會在 transaction 中執行
+    (pysqlite 預設只在 INSERT / UPDATE / DELETE 前開始 transaction)。
+    """
+    migration_engine = create_engine(engine.url)
+
+    @event.listens_for(migration_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(migration_engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    return migration_engine
+
+
+def migrate_products():
+    """
+    改名、建立新資料表、複製商品與刪除舊資料表在同一個 transaction 中，失敗時資料庫維持原狀。
+    """
+    migration_engine = transactional_engine()
+    try:
+        with migration_engine.begin() as conn:
+            inspector = inspect(conn)
+            if not inspector.has_table(LEGACY_TABLE):
+                conn.execute(text(f"ALTER TABLE products RENAME TO {LEGACY_TABLE}"))
+                conn.execute(text("DROP INDEX IF EXISTS ix_products_id"))
+            elif inspector.has_table("products") and conn.execute(text("SELECT count(*) FROM products")).scalar():
+                raise RuntimeError(f"Both products and {LEGACY_TABLE} have rows, resolve them manually")
+
+            Base.metadata.create_all(conn)
+
+            rows = conn.execute(text(f"SELECT * FROM {LEGACY_TABLE} ORDER BY id")).mappings().all()
+            session = Session(bind=conn)
+            for row in rows:
+                session.add(Product.from_dict(session, row))
+            session.flush()
+            session.close()
+
+            conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+    finally:
+        migration_engine.dispose()
+
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+
+    return len(rows)
+
+
+if __name__ == "__main__":
+    if is_legacy():
+        count = migrate_products()
+        print(f"Migrated {count} products")
+    else:
+        print("Already up to date.")
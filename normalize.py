@@ -0,0 +1,257 @@
+"""
+商品規格正規化
+
+把規格字串 ("500g"、"1.5L"、"200ml*6"、"12入"、"每包約7.5oz") 換算成基本單位的數量：
+重量為 g、容量為 ml、其他計件單位為 入，讓 `price_unit` (每單位價格) 可以互相比較。
+
+同樣的字串只會解析一次 (memoization)，整批商品先用 np.unique 去除重複，
+`price_unit` 則用 NumPy 一次算完。
+"""
+
+from __future__ import annotations
+
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import update
+
+from changes import PRICE_UNIT_TOLERANCE, product_state, record_changes
+from database import Product, StorePrice, Unit, get_or_create
+
+BASE_UNITS = ("g", "ml", "入")
+
+# 單位 -> (基本單位, 倍數)，比對時長的優先
+MEASURES = {
+    "公斤": ("g", 1000),
+    "千克": ("g", 1000),
+    "kg": ("g", 1000),
+    "公克": ("g", 1),
+    "克": ("g", 1),
+    "gm": ("g", 1),
+    "gr": ("g", 1),
+    "g": ("g", 1),
+    "mg": ("g", 0.001),
+    "台斤": ("g", 600),
+    "斤": ("g", 600),
+    "盎司": ("g", 28.3495),
+    "oz": ("g", 28.3495),
+    "磅": ("g", 453.592),
+    "lb": ("g", 453.592),
+    "公升": ("ml", 1000),
+    "毫升": ("ml", 1),
+    "升": ("ml", 1000),
+    "ml": ("ml", 1),
+    "cc": ("ml", 1),
+    "l": ("ml", 1000),
+}
+
+# 計件單位，都換算成 入
+COUNTS = (
+    "入", "包", "袋", "粒", "顆", "個", "片", "支", "瓶", "罐", "盒", "條", "捲", "組", "杯",
+    "塊", "枚", "張", "尾", "串", "pcs", "pc", "pack", "bag", "box", "bottle",
+)  # fmt: skip
+
+NUMBER = r"(\d+(?:\.\d+)?)"
+# 也接受 "1/2 lb" 這樣的分數，分母不能是 0
+FRACTION = r"(\d+(?:\.\d+)?(?:/[1-9]\d*)?)"
+
+
+def alternation(words: Iterable[str]) -> str:
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+# 數量 + 單位，前後可以有 "6包x"、"*6"、"x 6包" 之類的倍數；單位後面不能緊接英文字母 (x 除外)
+# 常見的 "120g克"、"200ml毫升" 會略過重複的中文單位
+MEASURE_PATTERN = re.compile(
+    rf"(?:(?<![\d.])(\d+)\s*(?:{alternation(COUNTS)})?\s*[*x×]\s*)?"
+    rf"{FRACTION}\s*({alternation(MEASURES)})(?![a-wyz])(?:公克|克|毫升|公升)?(?:\s*[*x×]\s*(\d+))?"
+)
+COUNT_PATTERN = re.compile(rf"(?<![\d.])(\d+)\s*({alternation(COUNTS)})(?![a-z])")
+
+# 罐頭的 "內容量240g固形量170g" 以內容量為準，"600g±30g" 的誤差範圍也略過
+DRAINED = ("固形量", "固形物", "固形", "固")
+TOLERANCE = ("±", "+-")
+# "600±30g" 的單位只寫在誤差後面，數量是 ± 前面的數字
+BARE_TOLERANCE = re.compile(rf"(?<![\d.]){NUMBER}\s*(?:{alternation(TOLERANCE)})$")
+
+
+def to_number(text: str) -> float:
+    numerator, _, denominator = text.partition("/")
+    return float(numerator) / float(denominator or 1)
+
+
+@lru_cache(maxsize=65536)
+def parse_size(text: str) -> Optional[Tuple[float, str]]:
+    """
+    解析規格字串，回傳 (數量, 基本單位)，找不到時回傳 None。
+    有多個重量 / 容量時取最後一個，沒有重量 / 容量時才使用計件數量。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+
+    measure = None
+    for m in MEASURE_PATTERN.finditer(text):
+        before, value, unit, after = m.groups()
+        prefix = text[: m.start()].rstrip()
+        if prefix.endswith(TOLERANCE):
+            bare = BARE_TOLERANCE.search(prefix)
+            if bare is not None:
+                measure = (float(bare.group(1)), unit, int(after or 1))
+            continue
+        if measure is not None and prefix.endswith(DRAINED):
+            # 固形量後面的倍數屬於內容量 ("230g固形量145gx3入")
+            if after and measure[2] == 1:
+                measure = (measure[0], measure[1], int(after))
+            continue
+        measure = (to_number(value), unit, int(before or 1) * int(after or 1))
+    if measure is not None:
+        value, unit, times = measure
+        base, factor = MEASURES[unit]
+        quantity = value * factor * times
+        if quantity > 0:
+            return round(quantity, 4), base
+
+    count = None
+    for m in COUNT_PATTERN.finditer(text):
+        count = m
+    if count is not None and int(count.group(1)) > 0:
+        return float(count.group(1)), "入"
+    return None
+
+
+def normalize_sizes(texts: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    批次解析規格字串，回傳 (數量, 基本單位) 兩個陣列，解析不到的數量為 nan、單位為空字串。
+    """
+    texts = np.array([t or "" for t in texts], dtype=object)
+    if len(texts) == 0:
+        return np.empty(0), np.empty(0, dtype=object)
+
+    unique, inverse = np.unique(texts, return_inverse=True)
+    parsed = [parse_size(t) for t in unique]
+    specs = np.array([p[0] if p else np.nan for p in parsed], dtype=np.float64)
+    units = np.array([p[1] if p else "" for p in parsed], dtype=object)
+    return specs[inverse], units[inverse]
+
+
+def price_units(prices, specs) -> np.ndarray:
+    """
+    每單位價格，數量不合理 (nan 或 <= 0) 的為 nan。
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    specs = np.asarray(specs, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(specs > 0, np.round(prices / specs, 4), np.nan)
+
+
+def resolve(specs, units, names) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    決定商品的 (數量, 基本單位)：
+    1. `specs` + `units` 本身是重量 / 容量 (例如 1 "L公升"、7.5 "oz盎司") 就直接換算
+    2. 否則從商品名稱找重量 / 容量 (例如 "港式蘿蔔糕800g" 的單位是 "PC條")
+    3. 都沒有時是計件商品，單位為 入；單位字串只有 1 個 (例如 "1Bag袋") 時以名稱中的數量 ("-8入") 為準
+    """
+    specs = np.asarray(specs, dtype=np.float64)
+    raw = [f"{s:g}{u}" if s > 0 else u for s, u in zip(specs, units)]
+    unit_specs, unit_units = normalize_sizes(raw)
+    name_specs, name_units = normalize_sizes(names)
+
+    from_unit = np.isin(unit_units, ("g", "ml"))
+    from_name = ~from_unit & np.isin(name_units, ("g", "ml"))
+    counted = ~from_unit & ~from_name
+
+    unit_counted = (unit_units == "入") & ~((unit_specs == 1) & (name_units == "入"))
+    count_specs = np.where(unit_counted, unit_specs, np.where(name_units == "入", name_specs, specs))
+    count_specs = np.where(count_specs > 0, count_specs, 1.0)
+
+    new_specs = np.where(from_unit, unit_specs, np.where(from_name, name_specs, count_specs))
+    new_units = np.where(from_unit, unit_units, np.where(from_name, name_units, "入")).astype(object)
+    new_units[counted] = "入"
+    return new_specs, new_units
+
+
+def normalize_rows(rows: List[Dict]) -> None:
+    """
+    爬蟲產生的商品資料 `spec` 是空的，原始規格字串在 `unit`，
+    在這裡補上 spec / unit / price_unit (直接修改 `rows`)。
+    """
+    missing = [row for row in rows if not row.get("spec")]
+    if not missing:
+        return
+    specs, units = resolve(np.zeros(len(missing)), [r["unit"] or "" for r in missing], [r["name"] for r in missing])
+    unit_prices = price_units([float(r["price"]) for r in missing], specs)
+    for row, spec, unit, price_unit in zip(missing, specs, units, unit_prices):
+        row["spec"], row["unit"], row["price_unit"] = float(spec), unit, float(price_unit)
+
+
+def normalize_products(session, generation_id: int) -> int:
+    """
+    把還不是基本單位的商品換算成 g / ml / 入，並一次重新計算所有商品的 price_unit，
+    有變動的商品在各門市的 price_unit (store_prices) 也依新的規格重新計算。
+    有變動的商品會記錄在 `generation_id` 的異動中 (規格換算為 "spec")。不會 commit。
+    回傳更新的商品數。
+    """
+    rows = (
+        session.query(Product.id, Product.name, Product.price, Product.spec, Product.price_unit, Unit.name)
+        .join(Unit, Product.unit_id == Unit.id)
+        .all()
+    )
+    if not rows:
+        return 0
+    ids, names, prices, specs, old_price_units, units = (np.array(c, dtype=object) for c in zip(*rows))
+    specs = specs.astype(np.float64)
+
+    new_specs, new_units = specs.copy(), units.copy()
+    pending = ~np.isin(units, BASE_UNITS) | ~(specs > 0)
+    if pending.any():
+        new_specs[pending], new_units[pending] = resolve(specs[pending], units[pending], names[pending])
+
+    new_price_units = price_units(prices.astype(np.float64), new_specs)
+    changed = (
+        (new_specs != specs)
+        | (new_units != units)
+        # 舊資料的 price_unit 進位方式不同，只差在進位的不重新寫入
+        | ~np.isclose(
+            new_price_units, old_price_units.astype(np.float64), rtol=0, atol=PRICE_UNIT_TOLERANCE, equal_nan=True
+        )
+    )
+    if not changed.any():
+        return 0
+
+    changed_ids = [int(i) for i in ids[changed]]
+    before = product_state(session, ids=changed_ids)
+    unit_ids = {unit: get_or_create(session, Unit, name=unit).id for unit in set(new_units[changed])}
+    session.execute(
+        update(Product),
+        [
+            {"id": int(i), "spec": float(s), "unit_id": unit_ids[u], "price_unit": float(p)}
+            for i, s, u, p in zip(ids[changed], new_specs[changed], new_units[changed], new_price_units[changed])
+        ],
+    )
+    update_store_price_units(session, dict(zip(changed_ids, new_specs[changed])))
+    record_changes(session, generation_id, before, ids=changed_ids)
+    return len(changed_ids)
+
+
+def update_store_price_units(session, specs: Dict[int, float]) -> None:
+    """
+    依商品的新規格 ({product_id: spec}) 重新計算各門市的 price_unit。不會 commit。
+    """
+    rows = (
+        session.query(StorePrice.product_id, StorePrice.store_id, StorePrice.price)
+        .filter(StorePrice.product_id.in_(list(specs)))
+        .all()
+    )
+    if not rows:
+        return
+    product_ids, store_ids, prices = zip(*rows)
+    new_price_units = price_units(prices, [specs[i] for i in product_ids])
+    values = [
+        {"product_id": product_id, "store_id": store_id, "price_unit": float(p)}
+        for product_id, store_id, p in zip(product_ids, store_ids, new_price_units)
+        if not np.isnan(p)
+    ]
+    if values:
+        session.execute(update(StorePrice), values)
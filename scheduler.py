@@ -0,0 +1,330 @@
+"""
+排程更新
+
+    python scheduler.py           持續依排程更新各通路商
+    python scheduler.py --once    各通路商立即更新一次後結束
+
+每個通路商依 INTERVALS 各自排程，並在不同的執行緒中同時更新，互不影響。
+一次更新會先切成以分類為單位的工作，每完成一個單位就連同價格一起寫入資料庫，
+中斷 (Ctrl-C 或程式當掉) 後重新啟動會從還沒完成的單位繼續。
+進度可以從 API 的 `/update/status` 查看。
+"""
+
+import argparse
+import asyncio
+import threading
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from changes import begin_generation, close_abandoned_generations, finish_generation
+from crawler import FingerprintStore, PX_Crawler, Telemetry
+from crawler.config import PX_STORES
+from database import Channel, Product, UpdateRun, WorkUnit, create_session, create_table
+from snapshot import build_snapshot
+from update import apply_cr4_prices, apply_px_prices, cr4_fetch_prices, normalize_update
+from update_status import INTERVALS, work_unit_counts
+
+# 每個工作單位最多嘗試幾次
+MAX_ATTEMPTS = 3
+
+# 檢查是否到了更新時間的間隔 (秒)
+POLL_SECONDS = 60
+
+
+class PXJob:
+    """
+    全聯: 每間門市的每個第三層分類是一個工作單位 (`門市/分類 id`)，
+    不同門市可以同時執行。
+    """
+
+    channel = "px"
+
+    def __init__(self, stores=PX_STORES, defer: bool = False):
+        self.stores = stores
+        self.defer = defer
+        self.crawlers: Dict[str, PX_Crawler] = {}
+        self.fingerprints = {shop_no: FingerprintStore(f"px_{shop_no}") for shop_no in stores}
+        self.telemetry = {shop_no: Telemetry(f"px_{shop_no}") for shop_no in stores}
+
+    def crawler(self, shop_no: str) -> PX_Crawler:
+        if shop_no not in self.crawlers:
+            crawler = PX_Crawler(self.fingerprints[shop_no], shop_no=shop_no, telemetry=self.telemetry[shop_no])
+            crawler.process_categories(save_result=False)
+            self.crawlers[shop_no] = crawler
+        return self.crawlers[shop_no]
+
+    def plan(self) -> List[str]:
+        keys = []
+        for shop_no in self.stores:
+            fingerprints = self.fingerprints[shop_no]
+            cats = [c for c in self.crawler(shop_no).categories.values() if c["level"] == 3]
+            cats, _ = fingerprints.prioritize(cats, key=lambda c: f"px/{shop_no}/{c['id']}", defer=self.defer)
+            keys.extend(f"{shop_no}/{c['id']}" for c in cats)
+        return keys
+
+    def lane(self, key: str) -> str:
+        return key.split("/")[0]
+
+    def fetch(self, key: str):
+        shop_no, category_id = key.split("/")
+        crawler = self.crawler(shop_no)
+        category_id = {str(c): c for c in crawler.categories}[category_id]
+        return {int(d["pid"]): int(d["price"]) for d in crawler.process_goods(category_id, save_result=False)}
+
+    def apply(self, session, generation_id: int, key: str, goods) -> Tuple[int, list]:
+        apply_px_prices(session, generation_id, {self.lane(key): goods}, self.stores[0])
+        return len(goods), []
+
+    def fingerprints_for(self, key: str) -> FingerprintStore:
+        return self.fingerprints[self.lane(key)]
+
+    def close(self) -> None:
+        for crawler in self.crawlers.values():
+            crawler.close()
+        for telemetry in self.telemetry.values():
+            telemetry.close()
+
+
+class CR4Job:
+    """
+    家樂福: 資料庫中每個商品分類是一個工作單位 (category_id)。
+    """
+
+    channel = "cr4"
+
+    def __init__(self, defer: bool = False):
+        self.defer = defer
+        self.fingerprints = FingerprintStore("cr4")
+        self.telemetry = Telemetry("cr4")
+
+    def products(self, session):
+        return session.query(Product).filter(Product.channel_id == Channel.id_of("家樂福"))
+
+    def plan(self) -> List[str]:
+        session = create_session()
+        try:
+            query = self.products(session).with_entities(Product.category_id).distinct()
+            return [str(category_id) for category_id, in query]
+        finally:
+            session.close()
+
+    def lane(self, key: str) -> str:
+        return self.channel
+
+    def fetch(self, key: str):
+        session = create_session()
+        try:
+            products = self.products(session).filter(Product.category_id == int(key)).all()
+        finally:
+            session.close()
+        products, _ = self.fingerprints.prioritize(products, key=lambda p: f"cr4/product/{p.pid}", defer=self.defer)
+
+        prices, errors = asyncio.run(
+            cr4_fetch_prices(products, self.fingerprints, progress=False, telemetry=self.telemetry)
+        )
+        if errors and len(errors) == len(products):
+            raise RuntimeError(f"All {len(errors)} products failed")
+        return prices, errors
+
+    def apply(self, session, generation_id: int, key: str, data) -> Tuple[int, list]:
+        prices, errors = data
+        apply_cr4_prices(session, generation_id, prices)
+        return len(prices), errors
+
+    def fingerprints_for(self, key: str) -> FingerprintStore:
+        return self.fingerprints
+
+    def close(self) -> None:
+        self.telemetry.close()
+
+
+JOBS = {
+    "px": PXJob,
+    "cr4": CR4Job,
+}
+
+
+class Scheduler:
+    def __init__(self, channels=tuple(JOBS)):
+        self.channels = channels
+        self.stop = threading.Event()
+        self.post_run_lock = threading.Lock()
+
+    def log(self, channel: str, message: str) -> None:
+        print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {channel}: {message}")
+
+    def due(self, session, channel: str) -> bool:
+        last = (
+            session.query(UpdateRun)
+            .filter(UpdateRun.channel == channel, UpdateRun.status.in_(("done", "failed")))
+            .order_by(UpdateRun.id.desc())
+            .first()
+        )
+        return last is None or last.started_at + INTERVALS[channel] <= datetime.now()
+
+    def run_channel(self, channel: str, force: bool = False) -> None:
+        """
+        繼續還沒完成的更新，或在時間到的時候開始新的更新。
+        """
+        session = create_session()
+        try:
+            run = (
+                session.query(UpdateRun)
+                .filter(UpdateRun.channel == channel, UpdateRun.status.in_(("planning", "running")))
+                .order_by(UpdateRun.id.desc())
+                .first()
+            )
+            if run is None:
+                if not force and not self.due(session, channel):
+                    return
+                run = UpdateRun(
+                    channel=channel,
+                    generation_id=begin_generation(),
+                    status="planning",
+                    started_at=datetime.now(),
+                )
+                session.add(run)
+                session.commit()
+                self.log(channel, f"start run {run.id}")
+            else:
+                self.log(channel, f"resume run {run.id}")
+            run_id = run.id
+        finally:
+            session.close()
+
+        job = JOBS[channel]()
+        try:
+            self.execute(job, run_id)
+        finally:
+            job.close()
+
+    def execute(self, job, run_id: int) -> None:
+        # 爬蟲的網路請求期間不持有資料庫連線，避免擋住另一個通路商寫入
+        session = create_session()
+        run = session.get(UpdateRun, run_id)
+        status, generation_id = run.status, run.generation_id
+        session.close()
+
+        if status == "planning":
+            keys = job.plan()
+            session = create_session()
+            session.query(WorkUnit).filter(WorkUnit.run_id == run_id).delete()
+            session.add_all(WorkUnit(run_id=run_id, key=key, status="pending", attempts=0) for key in keys)
+            session.get(UpdateRun, run_id).status = "running"
+            session.commit()
+            session.close()
+
+        session = create_session()
+        pending = [u.key for u in session.query(WorkUnit).filter_by(run_id=run_id, status="pending")]
+        session.close()
+
+        lanes = defaultdict(list)
+        for key in pending:
+            lanes[job.lane(key)].append(key)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(lanes))) as executor:
+            for future in [executor.submit(self.run_lane, job, run_id, generation_id, keys) for keys in lanes.values()]:
+                future.result()
+
+        if self.stop.is_set():
+            self.log(job.channel, f"run {run_id} interrupted, will resume")
+            return
+
+        session = create_session()
+        run = session.get(UpdateRun, run_id)
+        counts = work_unit_counts(session, run_id)
+        status = "failed" if counts["failed"] else "done"
+        run.status = status
+        run.finished_at = datetime.now()
+        session.commit()
+        session.close()
+
+        # 兩個通路商的正規化都會改寫整份商品資料，同時執行會 "database is locked"，所以依序執行
+        with self.post_run_lock:
+            try:
+                normalize_update(generation_id)
+            finally:
+                # 沒有完成的批次會擋住所有客戶端的異動同步，而 run 已經不會再繼續，所以一定要結束
+                finish_generation(generation_id)
+                # 正規化失敗時價格仍然已經寫入，快照也要重建
+                build_snapshot()
+        self.log(job.channel, f"run {run_id} {status}: {counts['done']} done, {counts['failed']} failed")
+
+    def run_lane(self, job, run_id: int, generation_id: int, keys: List[str]) -> None:
+        """
+        依序執行同一個 lane 的工作單位，失敗的單位排到最後重試。
+        先爬取資料，再連同工作單位的狀態在同一個 transaction 中寫入。
+        `job.apply()` 回傳 (更新的商品數, 失敗的商品)。
+        """
+        queue = list(keys)
+        while queue and not self.stop.is_set():
+            key = queue.pop(0)
+            fingerprints = job.fingerprints_for(key)
+            fingerprints.begin()
+            session = create_session()
+            try:
+                try:
+                    data = job.fetch(key)
+                    unit = session.get(WorkUnit, (run_id, key))
+                    unit.items, failed = job.apply(session, generation_id, key, data)
+                    unit.failed_items = len(failed)
+                    # 部分商品失敗時單位仍算完成，失敗的商品記在 error 中，下次更新會再嘗試
+                    unit.error = f"{len(failed)} failed: {' '.join(map(str, failed))}"[:300] if failed else None
+                    unit.status = "done"
+                except Exception as e:
+                    session.rollback()
+                    fingerprints.rollback()
+                    unit = session.get(WorkUnit, (run_id, key))
+                    unit.error = repr(e)[:300]
+                    unit.status = "failed" if unit.attempts + 1 >= MAX_ATTEMPTS else "pending"
+                    if unit.status == "pending":
+                        queue.append(key)
+                    self.log(job.channel, f"{key} failed: {e!r}")
+                unit.attempts += 1
+                unit.updated_at = datetime.now()
+                session.commit()
+                if unit.status == "done":
+                    fingerprints.commit()
+                    fingerprints.save()
+            finally:
+                session.close()
+
+    def channel_loop(self, channel: str, once: bool) -> None:
+        while not self.stop.is_set():
+            try:
+                self.run_channel(channel, force=once)
+            except Exception:
+                # 單一通路商失敗不影響其他通路商
+                self.log(channel, traceback.format_exc())
+            if once:
+                break
+            self.stop.wait(POLL_SECONDS)
+
+    def run(self, once: bool = False) -> None:
+        threads = [threading.Thread(target=self.channel_loop, args=(c, once), name=c) for c in self.channels]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(timeout=1)
+        except KeyboardInterrupt:
+            print("Stopping after the current work units...")
+            self.stop.set()
+            for t in threads:
+                t.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PriceScout update scheduler")
+    parser.add_argument("--once", action="store_true", help="各通路商立即更新一次後結束")
+    parser.add_argument("--channel", choices=list(JOBS), action="append", help="只更新指定的通路商")
+    args = parser.parse_args()
+
+    create_table()
+    channels = tuple(args.channel or JOBS)
+    close_abandoned_generations(channels)
+    Scheduler(channels).run(once=args.once)
@@ -0,0 +1,275 @@
+"""
+商品快照 (in-memory columnar snapshot)
+
+將 `products` 資料表整份載入成 NumPy 欄位陣列，
+分類與通路商以字典編碼 (dictionary encoding) 存成小整數，
+並事先依 `price_unit` 排序，讓 `/products` 不必經過 SQL 與 ORM 即可完成
+篩選 + 排序 + 分頁。
+
+快照只會在 update.py 更新資料後重建，
+每次重建存成 `data/snapshot/` 下一個新的版本資料夾，每個欄位一個 `.npy` 檔，
+`data/snapshot/current` 記錄目前的版本。
+載入時使用 memory-map，多個 uvicorn worker 可共用同一份 page cache。
+API 透過 SnapshotReloader 取得快照，重建後會自動換成新的快照。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from database import Product, create_session
+
+SNAPSHOT_DIR = "data/snapshot"
+
+# 每隔幾秒檢查一次快照是否重建過
+RELOAD_CHECK_SECONDS = 5
+
+# 記錄目前版本的檔案名稱
+CURRENT_FILE = "current"
+# 重建時保留最近幾個版本，舊版本可能還被 API 以 memory-map 開著
+KEEP_VERSIONS = 2
+
+# 以字典編碼儲存的欄位
+DICT_COLUMNS = ("channel", "category1", "category2", "category3", "unit")
+# 可能為 NULL 的字串欄位，另外存一個 mask
+NULLABLE_COLUMNS = ("pno", "barcode")
+# 直接存成陣列的欄位
+PLAIN_COLUMNS = {
+    "pid": np.int64,
+    "price": np.int32,
+    "spec": np.float64,
+    "price_unit": np.float64,
+    "pno": str,
+    "barcode": str,
+    "name": str,
+    "url": str,
+    "pic_url": str,
+}
+
+# SQLite 的 LIKE 只對 ASCII 字元不分大小寫
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def _fold(text: str) -> str:
+    return text.translate(_ASCII_LOWER)
+
+
+class ProductSnapshot:
+    def __init__(self, columns: Dict[str, np.ndarray], dictionaries: Dict[str, List[str]]):
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.codes = {col: {v: i for i, v in enumerate(values)} for col, values in dictionaries.items()}
+        self.size = len(columns["pid"])
+
+    def __len__(self) -> int:
+        return self.size
+
+    @classmethod
+    def from_rows(cls, rows: List[dict]) -> ProductSnapshot:
+        # 穩定排序，同價格的商品保持原本的順序 (與 SQL 的 ORDER BY price_unit, id 一致)
+        rows = sorted(rows, key=lambda r: r["price_unit"])
+
+        columns = {}
+        for col, dtype in PLAIN_COLUMNS.items():
+            values = [r[col] for r in rows]
+            if col in NULLABLE_COLUMNS:
+                columns[col + "_null"] = np.array([v is None for v in values], dtype=np.bool_)
+                values = ["" if v is None else v for v in values]
+            columns[col] = np.array(values, dtype=dtype)
+
+        dictionaries = {}
+        for col in DICT_COLUMNS:
+            values = sorted({r[col] for r in rows})
+            index = {v: i for i, v in enumerate(values)}
+            columns[col] = np.array([index[r[col]] for r in rows], dtype=np.int16)
+            dictionaries[col] = values
+
+        columns["name_key"] = np.array([_fold(r["name"]) for r in rows], dtype=str)
+
+        return cls(columns, dictionaries)
+
+    @classmethod
+    def from_database(cls) -> ProductSnapshot:
+        session = create_session()
+        try:
+            rows = [
+                {col: getattr(p, col) for col in (*PLAIN_COLUMNS, *DICT_COLUMNS)}
+                for p in session.query(Product).order_by(Product.price_unit, Product.id)
+            ]
+        finally:
+            session.close()
+        return cls.from_rows(rows)
+
+    def save(self, path: str = SNAPSHOT_DIR) -> str:
+        """
+        寫入新的版本資料夾後再換掉 `current`，回傳新的版本。
+        正在使用的版本資料夾不會被改名或覆寫 (Windows 上 memory-map 開著的檔案不能移動或刪除)，
+        舊版本在之後重建時才刪除，刪不掉 (還被開著) 的下次再試。
+        """
+        os.makedirs(path, exist_ok=True)
+        version = f"{time.time_ns()}"
+        tmp = os.path.join(path, version + ".tmp")
+        os.makedirs(tmp)
+
+        for col, arr in self.columns.items():
+            np.save(os.path.join(tmp, f"{col}.npy"), arr, allow_pickle=False)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"size": self.size, "columns": list(self.columns), "dictionaries": self.dictionaries},
+                f,
+                ensure_ascii=False,
+            )
+        os.rename(tmp, os.path.join(path, version))
+
+        pointer = os.path.join(path, CURRENT_FILE)
+        with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+            f.write(version)
+        for attempt in range(10):
+            try:
+                os.replace(pointer + ".tmp", pointer)
+                break
+            except PermissionError:
+                # Windows 上 API 剛好在讀取 current 時不能取代，稍後再試
+                if attempt == 9:
+                    raise
+                time.sleep(0.1)
+
+        versions = sorted(name for name in os.listdir(path) if name.isdigit())
+        for old in versions[:-KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+        return version
+
+    @classmethod
+    def load(cls, path: str = SNAPSHOT_DIR, mmap: bool = True, version: Optional[str] = None) -> ProductSnapshot:
+        directory = os.path.join(path, version or current_version(path))
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        mode = "r" if mmap else None
+        columns = {col: np.load(os.path.join(directory, f"{col}.npy"), mmap_mode=mode) for col in meta["columns"]}
+
+        if any(len(arr) != meta["size"] for arr in columns.values()):
+            raise RuntimeError(f"Snapshot at {directory} is inconsistent, rebuild it")
+
+        return cls(columns, meta["dictionaries"])
+
+    def _row(self, i: int) -> dict:
+        c = self.columns
+        row = {
+            "pid": int(c["pid"][i]),
+            "pno": None if c["pno_null"][i] else str(c["pno"][i]),
+            "barcode": None if c["barcode_null"][i] else str(c["barcode"][i]),
+            "name": str(c["name"][i]),
+            "price": int(c["price"][i]),
+            "spec": float(c["spec"][i]),
+            "price_unit": float(c["price_unit"][i]),
+            "url": str(c["url"][i]),
+            "pic_url": str(c["pic_url"][i]),
+        }
+        for col in DICT_COLUMNS:
+            row[col] = self.dictionaries[col][c[col][i]]
+        return row
+
+    def filter(
+        self,
+        category1: Optional[str] = None,
+        category2: Optional[str] = None,
+        category3: Optional[str] = None,
+        channel: Optional[str] = None,
+        query: Optional[str] = None,
+    ) -> np.ndarray:
+        """
+        回傳符合條件的列索引 (已依 `price_unit` 排序)。
+        """
+        mask = np.ones(self.size, dtype=np.bool_)
+
+        for col, value in (
+            ("category1", category1),
+            ("category2", category2),
+            ("category3", category3),
+            ("channel", channel),
+        ):
+            if value:
+                code = self.codes[col].get(value)
+                if code is None:
+                    return np.empty(0, dtype=np.intp)
+                mask &= self.columns[col] == code
+
+        idx = np.flatnonzero(mask)
+
+        if query:
+            for keyword in query.split():
+                exclude = keyword.startswith("-")
+                if exclude:
+                    keyword = keyword[1:]
+                found = np.char.find(self.columns["name_key"][idx], _fold(keyword)) >= 0
+                idx = idx[~found] if exclude else idx[found]
+
+        return idx
+
+    def query(
+        self,
+        category1: Optional[str] = None,
+        category2: Optional[str] = None,
+        category3: Optional[str] = None,
+        channel: Optional[str] = None,
+        query: Optional[str] = None,
+        page: int = 1,
+        limit: int = 10,
+    ) -> Tuple[int, List[dict]]:
+        idx = self.filter(category1, category2, category3, channel, query)
+        start = (page - 1) * limit
+        return len(idx), [self._row(i) for i in idx[start : start + limit]]
+
+
+def current_version(path: str = SNAPSHOT_DIR) -> str:
+    with open(os.path.join(path, CURRENT_FILE), "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+class SnapshotReloader:
+    """
+    持有目前的快照，`current` 指向新的版本 (update.py / scheduler.py 重建) 時載入新版本並替換。
+    正在查詢的請求繼續使用舊的快照，之後的請求才會用到新的。
+    """
+
+    def __init__(self, path: str = SNAPSHOT_DIR, check_seconds: float = RELOAD_CHECK_SECONDS):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.version = current_version(path)
+        self.snapshot = ProductSnapshot.load(path, version=self.version)
+        self.checked_at = time.monotonic()
+
+    def current(self) -> ProductSnapshot:
+        if time.monotonic() - self.checked_at >= self.check_seconds and self.lock.acquire(blocking=False):
+            try:
+                self.checked_at = time.monotonic()
+                version = current_version(self.path)
+                if version != self.version:
+                    self.snapshot = ProductSnapshot.load(self.path, version=version)
+                    self.version = version
+            except (OSError, RuntimeError):
+                # 讀不到新版本時繼續使用目前的快照，下次再檢查
+                pass
+            finally:
+                self.lock.release()
+        return self.snapshot
+
+
+def build_snapshot(path: str = SNAPSHOT_DIR) -> ProductSnapshot:
+    snapshot = ProductSnapshot.from_database()
+    snapshot.save(path)
+    return snapshot
+
+
+if __name__ == "__main__":
+    snapshot = build_snapshot()
+    print(f"Snapshot saved to {SNAPSHOT_DIR}: {len(snapshot)} products")
@@ -0,0 +1,17 @@
+import pytest
+from sqlalchemy import create_engine
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    改用暫存資料夾中的空白資料庫，不會動到 data/product.db。
+    用檔案而不是記憶體，main.warm_up() 關閉連線池也不會清掉資料。
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'product.db'}", connect_args={"check_same_thread": False})
+    monkeypatch.setattr(database, "engine", engine)
+    database.create_table()
+    yield engine
+    engine.dispose()
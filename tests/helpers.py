@@ -0,0 +1,28 @@
+from database import Product
+
+
+def make_product(session, **overrides) -> Product:
+    """
+    新增一個商品並 flush，欄位同 Product.from_dict，`overrides` 覆蓋預設值。
+    """
+    data = {
+        "pid": 1,
+        "pno": None,
+        "barcode": None,
+        "name": "測試商品",
+        "price": 100,
+        "spec": 100,
+        "unit": "g",
+        "price_unit": 1.0,
+        "channel": "全聯",
+        "category1": "",
+        "category2": "",
+        "category3": "",
+        **overrides,
+    }
+    data.setdefault("url", f"https://example.com/{data['pid']}")
+    data.setdefault("pic_url", f"https://example.com/{data['pid']}.jpg")
+    product = Product.from_dict(session, data)
+    session.add(product)
+    session.flush()
+    return product
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Rejected, client_id
+
+
+def test_client_id_direct_connection_ignores_headers():
+    headers = {"x-forwarded-for": "1.2.3.4", "cf-connecting-ip": "5.6.7.8"}
+    assert client_id(headers, "203.0.113.9") == "203.0.113.9"
+
+
+def test_client_id_behind_trusted_proxy():
+    assert client_id({"cf-connecting-ip": "5.6.7.8"}, "127.0.0.1") == "5.6.7.8"
+    # 最前面的值是客戶端自己填的，取代理加上的最後一個
+    assert client_id({"x-forwarded-for": "1.1.1.1, 5.6.7.8"}, "127.0.0.1") == "5.6.7.8"
+    assert client_id({"x-forwarded-for": "5.6.7.8, 127.0.0.1"}, "::1") == "5.6.7.8"
+    assert client_id({}, "127.0.0.1") == "127.0.0.1"
+
+
+def test_spoofed_header_does_not_reset_bucket():
+    admission = AdmissionController(rate=1, burst=10)
+
+    async def request(headers):
+        async with admission.admit(client_id(headers, "203.0.113.9"), 10):
+            pass
+
+    asyncio.run(request({}))
+    with pytest.raises(Rejected) as e:
+        asyncio.run(request({"x-forwarded-for": "9.9.9.9"}))
+    assert e.value.status == 429
@@ -0,0 +1,176 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from changes import (
+    begin_generation,
+    close_abandoned_generations,
+    finish_generation,
+    latest_generation,
+    product_state,
+    record_changes,
+)
+from database import Channel, ProductChange, Unit, UpdateRun, create_session, get_or_create
+from helpers import make_product
+
+
+def add_change(generation_id: int, pid: int) -> None:
+    session = create_session()
+    channel = session.query(Channel).filter_by(name="全聯").one_or_none() or Channel(name="全聯")
+    session.add(channel)
+    session.flush()
+    session.add(
+        ProductChange(generation_id=generation_id, product_id=pid, pid=pid, channel_id=channel.id, op="price", price=1)
+    )
+    session.commit()
+    session.close()
+
+
+def sync(since: int):
+    """
+    與 /products/changes 相同的範圍: (since, latest_generation]。
+    """
+    session = create_session()
+    generation = latest_generation(session)
+    pids = [
+        c.pid
+        for c in session.query(ProductChange)
+        .filter(ProductChange.generation_id > since, ProductChange.generation_id <= generation)
+        .order_by(ProductChange.id)
+    ]
+    session.close()
+    return generation, pids
+
+
+def test_no_generation(db):
+    assert sync(0) == (0, [])
+
+
+def test_interleaved_generations(db):
+    px, cr4 = begin_generation(), begin_generation()
+    add_change(px, 1)
+    add_change(cr4, 2)
+    finish_generation(cr4)
+
+    # px 還沒完成，cr4 的異動要等 px 完成後才一起同步
+    generation, pids = sync(0)
+    assert (generation, pids) == (0, [])
+
+    add_change(px, 3)
+    finish_generation(px)
+
+    generation, pids = sync(generation)
+    assert generation == cr4
+    assert sorted(pids) == [1, 2, 3]
+    assert sync(generation) == (cr4, [])
+
+
+def test_later_generation_still_running(db):
+    first = begin_generation()
+    add_change(first, 1)
+    finish_generation(first)
+    second = begin_generation()
+    add_change(second, 2)
+
+    assert sync(0) == (first, [1])
+    finish_generation(second)
+    assert sync(first) == (second, [2])
+
+
+def test_record_changes_ops(db):
+    session = create_session()
+    repriced = make_product(session, pid=1, price=100, spec=400, unit="g", price_unit=0.25, channel="家樂福")
+    respecified = make_product(session, pid=2, price=110, spec=1, unit="Bag袋", price_unit=110, channel="家樂福")
+    rounded = make_product(session, pid=3, price=49, spec=160, unit="g", price_unit=0.3063, channel="家樂福")
+    session.commit()
+
+    generation_id = begin_generation()
+    before = product_state(session)
+    repriced.price, repriced.price_unit = 120, 0.3
+    respecified.spec, respecified.price_unit = 8, 13.75
+    respecified._unit = get_or_create(session, Unit, name="入")
+    rounded.price_unit = 0.3062
+    assert record_changes(session, generation_id, before) == 2
+    session.commit()
+
+    changes = {c.pid: c for c in session.query(ProductChange)}
+    assert changes.keys() == {1, 2}
+    assert (changes[1].op, changes[1].price, changes[1].unit) == ("price", 120, "g")
+    assert (changes[2].op, changes[2].spec, changes[2].unit, changes[2].price_unit) == ("spec", 8, "入", 13.75)
+    session.close()
+
+
+def test_pages_pinned_while_generations_finish(db):
+    import main
+
+    def page(since, until, n):
+        response = asyncio.run(main.product_changes(since=since, until=until, page=n, limit=1))
+        return response["generation"], [c["pid"] for c in response["changes"]]
+
+    px, cr4 = begin_generation(), begin_generation()
+    add_change(px, 20)
+    add_change(cr4, 10)
+    add_change(px, 30)
+    finish_generation(px)
+
+    generation, first = page(0, None, 1)
+    assert (generation, first) == (px, [20])
+
+    # cr4 在翻頁之間完成，第 2 頁之後仍然只看 px 的範圍
+    finish_generation(cr4)
+    pids = first
+    n = 2
+    while True:
+        _, rows = page(0, generation, n)
+        if not rows:
+            break
+        pids += rows
+        n += 1
+    assert pids == [20, 30]
+
+    generation, pids = page(generation, None, 1)
+    assert (generation, pids) == (cr4, [10])
+
+
+def test_until_not_finished(db):
+    import main
+
+    begin_generation()
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(main.product_changes(since=0, until=1, page=1, limit=100))
+    assert e.value.status_code == 400
+
+
+def add_run(channel: str, generation_id: int) -> None:
+    session = create_session()
+    session.add(UpdateRun(channel=channel, generation_id=generation_id, status="running", started_at=datetime.now()))
+    session.commit()
+    session.close()
+
+
+def test_close_abandoned_generations(db):
+    first = begin_generation()
+    finish_generation(first)
+    abandoned = begin_generation()
+    for _ in range(3):
+        finish_generation(begin_generation())
+    assert sync(0)[0] == first
+
+    px, cr4 = begin_generation(), begin_generation()
+    add_run("px", px)
+    add_run("cr4", cr4)
+
+    # 排程中還會繼續的 run 不動
+    assert close_abandoned_generations() == 1
+    assert sync(0)[0] == abandoned + 3
+
+    # 只排程 px 時，cr4 的 run 不會再繼續
+    assert close_abandoned_generations(["px"]) == 1
+    session = create_session()
+    assert session.query(UpdateRun).filter_by(channel="cr4").one().status == "failed"
+    assert session.query(UpdateRun).filter_by(channel="px").one().status == "running"
+    finish_generation(px)
+    assert latest_generation(session) == cr4
+    session.close()
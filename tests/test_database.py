@@ -0,0 +1,25 @@
+from database import PX_URL_TEMPLATE, create_session
+from helpers import make_product
+
+
+def test_px_url_for_store(db):
+    url = PX_URL_TEMPLATE.format(barcode="4710000000000", pid=123, pno="A1", shop_no="025700")
+    session = create_session()
+    product = make_product(
+        session,
+        pid=123,
+        pno="A1",
+        barcode="4710000000000",
+        price=100,
+        spec=400,
+        price_unit=0.25,
+        url=url,
+        pic_url="https://image.pxgo.com.tw/pic/123.jpg",
+    )
+    session.commit()
+
+    assert product.url_part == ""
+    assert product.url == url
+    assert product.url_for("012345") == url.replace("shopNo=025700", "shopNo=012345")
+    assert product.pic_url == "https://image.pxgo.com.tw/pic/123.jpg"
+    session.close()
@@ -0,0 +1,62 @@
+from crawler.fingerprint import MAX_INTERVAL, FingerprintStore
+
+
+def test_check_and_save(tmp_path):
+    fingerprints = FingerprintStore("px", state_dir=tmp_path)
+    assert FingerprintStore.digest("頁面") == FingerprintStore.digest("頁面".encode("utf-8"))
+
+    assert fingerprints.check("px/1/1", b"a")
+    assert not fingerprints.check("px/1/1", b"a")
+    assert fingerprints.check("px/1/1", b"b")
+    fingerprints.save()
+
+    # 下一次執行讀回上次的雜湊
+    fingerprints = FingerprintStore("px", state_dir=tmp_path)
+    assert fingerprints.run == 2
+    assert not fingerprints.check("px/1/1", b"b")
+    assert fingerprints.entries["px/1/1"]["checks"] == 4
+
+
+def test_rollback(tmp_path):
+    fingerprints = FingerprintStore("cr4", state_dir=tmp_path)
+    fingerprints.check("cr4/product/1", "100")
+    before = dict(fingerprints.entries["cr4/product/1"])
+
+    fingerprints.begin()
+    fingerprints.check("cr4/product/1", "90")
+    fingerprints.check("cr4/product/2", "50")
+    fingerprints.rollback()
+
+    # 沒寫入資料庫的頁面下次仍要視為有變動
+    assert fingerprints.entries == {"cr4/product/1": before}
+    assert fingerprints.check("cr4/product/1", "90")
+
+    fingerprints.begin()
+    fingerprints.check("cr4/product/2", "50")
+    fingerprints.commit()
+    fingerprints.rollback()
+    assert "cr4/product/2" in fingerprints.entries
+
+
+def test_prioritize_keeps_every_item(tmp_path):
+    fingerprints = FingerprintStore("cr4", state_dir=tmp_path)
+    for _ in range(10):
+        fingerprints.record("stable", False)
+        fingerprints.record("busy", True)
+
+    due, deferred = fingerprints.prioritize(["stable", "new", "busy"], key=str)
+    assert due == ["new", "busy", "stable"]
+    assert deferred == []
+
+
+def test_prioritize_defer(tmp_path):
+    fingerprints = FingerprintStore("cr4", state_dir=tmp_path)
+    for _ in range(10):
+        fingerprints.record("stable", False)
+        fingerprints.record("busy", True)
+
+    # 剛檢查過的穩定項目延後，但最多隔 MAX_INTERVAL 次就要再爬
+    fingerprints.run += 1
+    assert fingerprints.prioritize(["stable", "busy"], key=str, defer=True) == (["busy"], ["stable"])
+    fingerprints.run += MAX_INTERVAL
+    assert fingerprints.prioritize(["stable", "busy"], key=str, defer=True) == (["busy", "stable"], [])
@@ -0,0 +1,77 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from crawler.governor import HostState, RequestGovernor, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_token_bucket():
+    state = HostState(rate=2, max_limit=4)
+    state.limit = 4
+    now = state.updated
+    assert state.try_acquire(now) == 0
+    assert state.try_acquire(now) == 0
+    # 每秒 2 個，用完後要等半秒
+    assert state.try_acquire(now) == 0.5
+    assert state.try_acquire(now + 0.5) == 0
+
+
+def test_aimd_and_retry_after():
+    state = HostState(rate=100, max_limit=4)
+    now = state.updated
+    for _ in range(10):
+        assert state.try_acquire(now) == 0
+        state.release(now, 0.1, 200, None)
+    assert state.limit == 4
+
+    state.try_acquire(now)
+    state.release(now, 0.1, 429, 2.0)
+    assert state.limit == 2
+    # Retry-After 期間暫停所有請求
+    assert state.try_acquire(now + 1.5) == 0.5
+    assert state.try_acquire(now + 2) == 0
+
+    # 沒有 Retry-After 時從 1 秒開始退避
+    state.release(now + 2, 0.1, 503, None)
+    assert (state.limit, state.blocked_until) == (1, now + 3)
+
+
+def test_governor_against_throttling_server(db):
+    from benchmark import ThrottlingHandler
+
+    class Handler(ThrottlingHandler):
+        max_concurrent = 2
+        max_per_second = 1000
+        lock = threading.Lock()
+        in_flight = 0
+        recent = deque()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    governor = RequestGovernor(rate=100, max_limit=4)
+    session = requests.Session()
+    try:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            statuses = list(
+                executor.map(lambda _: governor.send(url, lambda: session.get(url, timeout=10)).status_code, range(20))
+            )
+    finally:
+        session.close()
+        server.shutdown()
+
+    # 被限流時減少同時請求數並依 Retry-After 重試，最後全部成功
+    assert statuses == [200] * 20
+    (stats,) = governor.stats().values()
+    assert stats["throttled"] > 0
@@ -0,0 +1,41 @@
+from datetime import date
+
+from database import PriceHistory, create_session
+from helpers import make_product
+from history import month_key, price_history, record_prices
+
+
+def test_same_day_revert_to_previous_month(db):
+    session = create_session()
+    product_id = make_product(session, price=90, price_unit=0.9).id
+    session.commit()
+
+    record_prices(session, {product_id: 90}, date(2026, 9, 10))
+    session.commit()
+    assert record_prices(session, {product_id: 100}, date(2026, 10, 19)) == 1
+    session.commit()
+    record_prices(session, {product_id: 90}, date(2026, 10, 19))
+    session.commit()
+
+    months = [row.month for row in session.query(PriceHistory).filter_by(product_id=product_id)]
+    assert months == [month_key(date(2026, 9, 1))]
+    assert price_history(session, product_id, date(2026, 9, 1), date(2026, 10, 31)) == [(date(2026, 9, 10), 90)]
+    session.close()
+
+
+def test_same_day_change_keeps_new_price(db):
+    session = create_session()
+    product_id = make_product(session, price=90, price_unit=0.9).id
+    session.commit()
+
+    record_prices(session, {product_id: 90}, date(2026, 9, 10))
+    record_prices(session, {product_id: 100}, date(2026, 10, 19))
+    session.commit()
+    record_prices(session, {product_id: 95}, date(2026, 10, 19))
+    session.commit()
+
+    assert price_history(session, product_id, date(2026, 9, 1), date(2026, 10, 31)) == [
+        (date(2026, 9, 10), 90),
+        (date(2026, 10, 19), 95),
+    ]
+    session.close()
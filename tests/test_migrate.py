@@ -0,0 +1,62 @@
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+import migrate
+from database import Base, Product, create_session
+
+LEGACY_SCHEMA = """
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY, pid BIGINT, pno VARCHAR(20), barcode VARCHAR(20), name VARCHAR(100), price INTEGER,
+    spec FLOAT, unit VARCHAR(10), price_unit FLOAT, channel VARCHAR(20), category1 VARCHAR(20),
+    category2 VARCHAR(20), category3 VARCHAR(20), url VARCHAR(300), pic_url VARCHAR(300)
+)
+"""
+
+
+@pytest.fixture
+def legacy_db(db, monkeypatch):
+    monkeypatch.setattr(migrate, "engine", db)
+    Base.metadata.drop_all(db)
+    with db.begin() as conn:
+        conn.execute(text(LEGACY_SCHEMA))
+        for i, unit in enumerate(["g", None], start=1):
+            conn.execute(
+                text(
+                    "INSERT INTO products VALUES (:id, :id, NULL, NULL, '商品', 100, 100, :unit, 1, '全聯', "
+                    "'', '', '', 'https://example.com/' || :id, 'https://example.com/' || :id || '.jpg')"
+                ),
+                {"id": i, "unit": unit},
+            )
+    return db
+
+
+def test_failed_migration_leaves_legacy_table(legacy_db):
+    assert migrate.is_legacy()
+    with pytest.raises(IntegrityError):
+        migrate.migrate_products()
+
+    # 轉換失敗時資料庫維持原狀，可以修正資料後重新執行
+    assert inspect(legacy_db).get_table_names() == ["products"]
+    assert migrate.is_legacy()
+
+    with legacy_db.begin() as conn:
+        conn.execute(text("UPDATE products SET unit = 'g' WHERE unit IS NULL"))
+    assert migrate.migrate_products() == 2
+    assert not migrate.is_legacy()
+
+    session = create_session()
+    assert [p.unit for p in session.query(Product).order_by(Product.id)] == ["g", "g"]
+    session.close()
+
+
+def test_leftover_legacy_table(legacy_db):
+    # 舊版沒有 transaction 的轉換中途失敗，留下 products_legacy 與空的 products
+    with legacy_db.begin() as conn:
+        conn.execute(text("UPDATE products SET unit = 'g' WHERE unit IS NULL"))
+        conn.execute(text(f"ALTER TABLE products RENAME TO {migrate.LEGACY_TABLE}"))
+    Base.metadata.create_all(legacy_db)
+
+    assert migrate.is_legacy()
+    assert migrate.migrate_products() == 2
+    assert not inspect(legacy_db).has_table(migrate.LEGACY_TABLE)
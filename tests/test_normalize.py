@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from database import Store, StorePrice, create_session, get_or_create
+from helpers import make_product
+from normalize import normalize_products, parse_size, price_units, resolve
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("500g", (500.0, "g")),
+        ("1.5L", (1500.0, "ml")),
+        ("200ml*6", (1200.0, "ml")),
+        ("6包x8g", (48.0, "g")),
+        ("12入", (12.0, "入")),
+        ("每包約7.5oz", (212.6213, "g")),
+        ("1/2 lb", (226.796, "g")),
+        ("3/4oz x 2", (42.5242, "g")),
+        ("120g克", (120.0, "g")),
+        ("1公斤", (1000.0, "g")),
+        ("內容量240g固形量170g", (240.0, "g")),
+        ("230g固形量145gx3入", (690.0, "g")),
+        ("600g±30g", (600.0, "g")),
+        ("600±30g", (600.0, "g")),
+        ("中一國民蛋 (白蛋) 10入 / 600±30g", (600.0, "g")),
+        ("630公克±30公克", (630.0, "g")),
+        ("十方苑-雜糧饅頭(全素)-8入", (8.0, "入")),
+        ("±30g", None),
+        ("鮮奶", None),
+        ("", None),
+    ],
+)
+def test_parse_size(text, expected):
+    assert parse_size(text) == expected
+
+
+def test_resolve_prefers_unit_measure():
+    specs, units = resolve([1, 7.5], ["L公升", "oz盎司"], ["某某果汁", "某某堅果"])
+    assert specs.tolist() == [1000.0, 212.6213]
+    assert units.tolist() == ["ml", "g"]
+
+
+def test_resolve_name_measure_and_counts():
+    specs, units = resolve(
+        [1, 1, 6, 1],
+        ["PC條", "Bag袋", "Bag袋", "Bag袋"],
+        ["港式蘿蔔糕800g", "十方苑-雜糧饅頭(全素)-8入", "某某-8入", "饅頭"],
+    )
+    assert specs.tolist() == [800.0, 8.0, 6.0, 1.0]
+    assert units.tolist() == ["g", "入", "入", "入"]
+
+
+def test_price_units():
+    result = price_units([100, 50, 10], [400, 0, np.nan])
+    assert result[0] == 0.25
+    assert np.isnan(result[1:]).all()
+
+
+def test_normalize_products_empty_table(db):
+    session = create_session()
+    assert normalize_products(session, 1) == 0
+    session.close()
+
+
+def test_normalize_products_store_price_units(db):
+    session = create_session()
+    product = make_product(session, name="某某果汁", spec=1, unit="L公升", price_unit=100)
+    store = get_or_create(session, Store, shop_no="012345")
+    session.add(StorePrice(product_id=product.id, store_id=store.id, price=80, price_unit=80))
+    session.commit()
+
+    assert normalize_products(session, 1) == 1
+    session.commit()
+
+    assert (product.spec, product.unit, product.price_unit) == (1000, "ml", 0.1)
+    assert session.query(StorePrice.price_unit).scalar() == 0.08
+    session.close()
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from changes import begin_generation
+from database import Product, StorePrice, create_session
+from helpers import make_product
+from snapshot import KEEP_VERSIONS, ProductSnapshot, SnapshotReloader, build_snapshot, current_version
+
+NAMES = [
+    "100%純柳橙汁",
+    "鮮乳_低脂",
+    "Milk Tea 奶茶",
+    "milk 牛奶",
+    "辣味泡麵",
+    "原味泡麵",
+    "50%off 餅乾",
+    "鮮乳",
+]
+
+
+@pytest.fixture
+def backends(db):
+    session = create_session()
+    for i, name in enumerate(NAMES, start=1):
+        make_product(session, pid=i, name=name, price=10 * i, price_unit=0.1 * (i % 3))
+    session.commit()
+    session.close()
+
+    # main 在 import 時會在 (已換成測試用的) 資料庫上建立資料表
+    import main
+
+    return main.query_products, ProductSnapshot.from_database().query
+
+
+@pytest.mark.parametrize("query", ["%", "_", "%off", "鮮乳_", "-%", "-_ 鮮乳", "milk", "泡麵 -辣", "-"])
+def test_sql_and_snapshot_match(backends, query):
+    sql, snapshot = backends
+    sql_total, sql_rows = sql(query=query, limit=100)
+    snapshot_total, snapshot_rows = snapshot(query=query, limit=100)
+
+    assert sql_total == snapshot_total
+    assert [p.pid for p in sql_rows] == [p["pid"] for p in snapshot_rows]
+
+
+def test_wildcards_match_literally(backends):
+    sql, _ = backends
+    assert sql(query="%")[0] == 2
+    assert sql(query="_")[0] == 1
+
+
+def test_snapshot_reloaded_after_rebuild(backends, tmp_path):
+    path = str(tmp_path / "snapshot")
+    build_snapshot(path)
+    snapshots = SnapshotReloader(path, check_seconds=0)
+    before = snapshots.current()
+
+    session = create_session()
+    session.query(Product).filter(Product.pid == 1).one().price = 999
+    session.commit()
+    session.close()
+    build_snapshot(path)
+
+    after = snapshots.current()
+    assert after is not before
+    assert after.query(query="100%")[1][0]["price"] == 999
+    assert snapshots.current() is after
+
+
+def test_snapshot_versions(backends, tmp_path):
+    path = str(tmp_path / "snapshot")
+    versions = []
+    for _ in range(KEEP_VERSIONS + 1):
+        snapshot = build_snapshot(path)
+        versions.append(current_version(path))
+        # 舊版本的資料夾不會被改名，正在使用的 memory-map 不受影響
+        assert ProductSnapshot.load(path).query(limit=100) == snapshot.query(limit=100)
+
+    assert sorted(os.listdir(path)) == sorted(versions[-KEEP_VERSIONS:] + ["current"])
+
+
+def test_store_prices(db):
+    from update import apply_px_prices
+
+    generation_id = begin_generation()
+    session = create_session()
+    for pid in (1, 2, 3):
+        make_product(session, pid=pid, spec=100, price=100, price_unit=1.0)
+    make_product(session, pid=4, channel="家樂福", price=10, price_unit=0.1)
+    apply_px_prices(session, generation_id, {"025700": {1: 300, 2: 200}, "000001": {1: 50, 3: 80}}, "025700")
+    session.commit()
+
+    # 預設門市只寫回商品本身
+    assert {p.pid: p.price for p in session.query(Product).filter(Product.pid <= 3)} == {1: 300, 2: 200, 3: 100}
+    assert session.query(StorePrice).count() == 2
+    session.close()
+
+    import main
+
+    total, products = main.query_products(store="025700")
+    assert total == 3
+    assert [(p.pid, p.price) for p in products] == [(3, 100), (2, 200), (1, 300)]
+
+    # 其他門市依門市的單位價格排序，網址換成該門市
+    total, products = main.query_products(store="000001")
+    assert total == 2
+    assert [(p["pid"], p["price"], p["price_unit"]) for p in products] == [(1, 50, 0.5), (3, 80, 0.8)]
+    assert products[0]["url"].startswith("https://example.com/")
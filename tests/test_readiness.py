@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+from fastapi import Response
+from sqlalchemy import event
+
+
+@pytest.fixture
+def main(db, monkeypatch):
+    import main
+
+    # 預熱用測試的資料庫，進度從頭開始
+    monkeypatch.setattr(main, "engine", db)
+    monkeypatch.setattr(main, "DB_URL", str(db.url))
+    monkeypatch.setattr(
+        main, "readiness", {"status": "warming up", "warm_up_seconds": None, "steps": {}, "error": None}
+    )
+    return main
+
+
+def readyz(main):
+    response = Response()
+    body = asyncio.run(main.readyz(response))
+    return response.status_code, body
+
+
+def test_not_ready_before_warm_up(main):
+    status_code, body = readyz(main)
+    assert (status_code, body["status"]) == (503, "warming up")
+    # import main 不會預熱連線，benchmark 量到的才是冷的連線
+    assert not event.contains(main.engine, "connect", main.warm_connection)
+
+
+def test_ready_after_warm_up(main):
+    main.warm_up()
+
+    status_code, body = readyz(main)
+    assert (status_code, body["status"], body["error"]) == (200, "ready", None)
+    assert list(body["steps"]) == ["database_file", "connections", "products", "categories"]
+    assert body["warm_up_seconds"] >= 0
+    assert event.contains(main.engine, "connect", main.warm_connection)
+
+
+def test_failed_warm_up(main, monkeypatch):
+    def category_tree():
+        raise RuntimeError("no such table: category_paths")
+
+    monkeypatch.setattr(main, "category_tree", category_tree)
+    main.warm_up()
+
+    status_code, body = readyz(main)
+    assert (status_code, body["status"]) == (503, "failed")
+    assert "no such table" in body["error"]
+    # 完成的步驟仍然記錄下來
+    assert list(body["steps"]) == ["database_file", "connections", "products"]
@@ -0,0 +1,150 @@
+from datetime import datetime
+
+import pytest
+
+import scheduler
+from changes import begin_generation, latest_generation
+from crawler import FingerprintStore
+from database import UpdateRun, WorkUnit, create_session
+
+
+class FakeFingerprints:
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def save(self):
+        pass
+
+
+class FakeJob:
+    channel = "cr4"
+
+    def plan(self):
+        return []
+
+    def lane(self, key):
+        return self.channel
+
+    def fetch(self, key):
+        return {}
+
+    def apply(self, session, generation_id, key, data):
+        return 0, []
+
+    def fingerprints_for(self, key):
+        return FakeFingerprints()
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def post_run(monkeypatch):
+    """
+    略過正規化與重建快照，只留下批次的結束。
+    """
+    monkeypatch.setattr(scheduler, "normalize_update", lambda generation_id: None)
+    monkeypatch.setattr(scheduler, "build_snapshot", lambda: None)
+
+
+def unit_states(channel: str):
+    session = create_session()
+    run = session.query(UpdateRun).filter_by(channel=channel).one()
+    units = {u.key: (u.status, u.attempts) for u in session.query(WorkUnit).filter_by(run_id=run.id)}
+    status = run.status
+    session.close()
+    return status, units
+
+
+def test_generation_finished_when_normalize_fails(db, monkeypatch):
+    def fail(generation_id):
+        raise RuntimeError("database is locked")
+
+    snapshots = []
+
+    def build_snapshot():
+        session = create_session()
+        snapshots.append(latest_generation(session))
+        session.close()
+
+    monkeypatch.setattr(scheduler, "normalize_update", fail)
+    monkeypatch.setattr(scheduler, "build_snapshot", build_snapshot)
+
+    generation_id = begin_generation()
+    session = create_session()
+    run = UpdateRun(channel="cr4", generation_id=generation_id, status="running", started_at=datetime.now())
+    session.add(run)
+    session.flush()
+    session.add(WorkUnit(run_id=run.id, key="1", status="pending", attempts=0))
+    session.commit()
+    run_id = run.id
+    session.close()
+
+    with pytest.raises(RuntimeError):
+        scheduler.Scheduler().execute(FakeJob(), run_id)
+
+    session = create_session()
+    assert session.get(UpdateRun, run_id).status == "done"
+    assert latest_generation(session) == generation_id
+    session.close()
+    # 快照在批次結束後重建
+    assert snapshots == [generation_id]
+
+
+def test_resume_after_stop(db, post_run, monkeypatch):
+    fetched = []
+    runner = scheduler.Scheduler(channels=("cr4",))
+
+    class Job(FakeJob):
+        def plan(self):
+            return ["1", "2", "3"]
+
+        def fetch(self, key):
+            fetched.append(key)
+            # 做完第 2 個單位時中斷 (Ctrl-C)
+            if key == "2":
+                runner.stop.set()
+            return {}
+
+    monkeypatch.setitem(scheduler.JOBS, "cr4", Job)
+
+    runner.run_channel("cr4", force=True)
+    assert fetched == ["1", "2"]
+    assert unit_states("cr4") == ("running", {"1": ("done", 1), "2": ("done", 1), "3": ("pending", 0)})
+
+    # 重新啟動後只執行還沒完成的單位，不會重新規劃
+    runner = scheduler.Scheduler(channels=("cr4",))
+    runner.run_channel("cr4")
+    assert fetched == ["1", "2", "3"]
+    assert unit_states("cr4") == ("done", {"1": ("done", 1), "2": ("done", 1), "3": ("done", 1)})
+
+
+def test_failing_unit_rolls_back_fingerprints(db, post_run, monkeypatch, tmp_path):
+    fingerprints = FingerprintStore("cr4", state_dir=tmp_path)
+
+    class Job(FakeJob):
+        def plan(self):
+            return ["bad", "ok"]
+
+        def fetch(self, key):
+            fingerprints.check(f"cr4/{key}", "page")
+            if key == "bad":
+                raise RuntimeError("blocked")
+            return {}
+
+        def fingerprints_for(self, key):
+            return fingerprints
+
+    monkeypatch.setitem(scheduler.JOBS, "cr4", Job)
+    scheduler.Scheduler(channels=("cr4",)).run_channel("cr4", force=True)
+
+    # 失敗的單位重試到 MAX_ATTEMPTS 次後放棄，其他單位照常完成
+    assert unit_states("cr4") == ("failed", {"bad": ("failed", scheduler.MAX_ATTEMPTS), "ok": ("done", 1)})
+    # 沒有寫入資料庫的頁面不能留下指紋，否則下次會被當成沒有變動
+    assert list(fingerprints.entries) == ["cr4/ok"]
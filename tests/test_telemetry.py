@@ -0,0 +1,21 @@
+import json
+from functools import partial
+
+import update
+from crawler.telemetry import Telemetry
+
+
+def test_store_failure_recorded(db, tmp_path, monkeypatch):
+    class FailingCrawler:
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError("login failed")
+
+    monkeypatch.setattr(update, "PX_Crawler", FailingCrawler)
+    monkeypatch.setattr(update, "Telemetry", partial(Telemetry, directory=str(tmp_path)))
+
+    # 單一門市失敗不會中斷更新，失敗記錄在該門市的 telemetry
+    update.px_update(0, stores=("000001",))
+
+    (path,) = (tmp_path / "px_000001").glob("*.jsonl")
+    (event,) = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert (event["class"], event["key"], event["error"]) == ("px/store", "000001", "RuntimeError")
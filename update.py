@@ -1,74 +1,260 @@
 import asyncio
 import csv
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import aiohttp
 from bs4 import BeautifulSoup
 from tqdm import tqdm
-from tqdm.asyncio import tqdm_asyncio
 
-from crawler import PX_Crawler
-from database import Product, create_session, create_table, drop_table
+from changes import begin_generation, close_abandoned_generations, finish_generation, product_state, record_changes
+from crawler import GOVERNOR, FingerprintStore, PX_Crawler, Telemetry
+from crawler.config import MAX_CONCURRENT_REQUESTS, PX_STORES, TIMEOUT
+from database import (
+    PRODUCT_FIELDS,
+    Channel,
+    Product,
+    Store,
+    StorePrice,
+    create_session,
+    create_table,
+    drop_table,
+    get_or_create,
+)
+from history import record_prices
+from normalize import normalize_products, normalize_rows
+from snapshot import build_snapshot
 
 
-def px_update():
+def px_crawl_store(shop_no: str, defer: bool = False, position: int = 0):
+    """
+    爬取一間全聯門市的商品價格，回傳 ({pid: price}, fingerprints)。
+    只會包含內容有變動的頁面中的商品。最多 MAX_CONCURRENT_REQUESTS 個分類同時爬取。
+    整間門市的爬取在 telemetry 中另外記錄一筆 `px/store` (key 為門市編號)，門市失敗時記錄失敗原因。
+    """
+    fingerprints = FingerprintStore(f"px_{shop_no}")
+    telemetry = Telemetry(f"px_{shop_no}")
+    try:
+        with telemetry.request("px/store", key=shop_no) as event:
+            with PX_Crawler(fingerprints, shop_no=shop_no, telemetry=telemetry) as crawler:
+                crawler.process_categories(save_result=False)
+                cats = [c for c in crawler.categories.values() if c["level"] == 3]
+                cats, _ = fingerprints.prioritize(cats, key=lambda c: f"px/{shop_no}/{c['id']}", defer=defer)
+
+                # 同時處理多個分類，實際同時送出的請求數由 GOVERNOR 依回應狀況調整
+                prices = {}
+                with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                    futures = [executor.submit(crawler.process_goods, c["id"], save_result=False) for c in cats]
+                    for future in tqdm(
+                        as_completed(futures), total=len(futures), desc=f"PX Mart {shop_no}", position=position
+                    ):
+                        for d in future.result():
+                            prices[int(d["pid"])] = int(d["price"])
+            event.items = len(prices)
+    finally:
+        telemetry.close()
+    return prices, fingerprints
+
+
+def apply_px_prices(session, generation_id: int, results, reference_store: str = PX_STORES[0]):
+    """
+    寫入各門市爬到的價格 ({shop_no: {pid: price}})，
+    各門市的價格存在 store_prices，`reference_store` 的價格只寫回商品本身，
+    並記錄價格歷史與商品異動。不會 commit。
+    """
+    pids = {pid for goods in results.values() for pid in goods}
+    products = {
+        p.pid: p
+        for p in session.query(Product).filter(Product.channel_id == Channel.id_of("全聯"), Product.pid.in_(pids))
+    }
+    ids = [p.id for p in products.values()]
+    before = product_state(session, ids=ids)
+
+    prices = {}
+    for shop_no, goods in results.items():
+        store = get_or_create(session, Store, shop_no=shop_no)
+        store_prices = {
+            sp.product_id: sp
+            for sp in session.query(StorePrice).filter(StorePrice.store_id == store.id, StorePrice.product_id.in_(ids))
+        }
+
+        for pid, price in goods.items():
+            product = products.get(pid)
+            if product is None:
+                # print(pid, "Not found")
+                continue
+            price_unit = round(price / product.spec, 4)
+
+            if shop_no == reference_store:
+                product.price = price
+                product.price_unit = price_unit
+                prices[product.id] = price
+                continue
+
+            sp = store_prices.get(product.id)
+            if sp is None:
+                session.add(StorePrice(product_id=product.id, store_id=store.id, price=price, price_unit=price_unit))
+            else:
+                sp.price, sp.price_unit = price, price_unit
+
+    record_prices(session, prices)
+    record_changes(session, generation_id, before, ids=ids)
+
+
+def px_update(generation_id: int, defer: bool = False, stores=PX_STORES):
+    """
+    同時爬取多間門市，所有門市共用同一個 GOVERNOR 控制請求速率。
+    各門市的價格存在 store_prices，第一間門市的價格同時寫回商品本身。
+    單一門市失敗不影響其他門市。
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(stores)) as executor:
+        futures = {shop_no: executor.submit(px_crawl_store, shop_no, defer, i) for i, shop_no in enumerate(stores)}
+        for shop_no, future in futures.items():
+            try:
+                results[shop_no] = future.result()
+            except Exception:
+                # 失敗的原因已記錄在該門市的 telemetry (px/store)，其他門市照常寫入
+                continue
+
     session = create_session()
-    with PX_Crawler() as crawler:
-        # products = crawler.get_all_products(save_result=False)
-
-        crawler.process_categories(save_result=False)
-        cats = [c for c in crawler.categories.values() if c["level"] == 3]
-
-        for cat in tqdm(cats, desc="PX Mart"):
-            for d in crawler.process_goods(cat["id"], save_result=False):
-                pid = d["pid"]
-                product = session.query(Product).filter(Product.pid == pid).first()
-                if product:
-                    price, unit = int(d["price"]), product.spec
-                    product.price = price
-                    product.price_unit = round(price / unit, 4)
-                # else:
-                #     print(d, "Not found")
+    apply_px_prices(session, generation_id, {shop_no: goods for shop_no, (goods, _) in results.items()}, stores[0])
     session.commit()
     session.close()
 
+    for _, fingerprints in results.values():
+        fingerprints.save()
+        print(fingerprints.summary())
+
+
+async def cr4_get_product_price(pid, fingerprints: FingerprintStore = None, telemetry: Telemetry = None, category=None):
+    """
+    有設定 fingerprints 時使用條件式請求，
+    商品頁沒有變動 (304 或價格相同) 則回傳 None。
+    請求速率由 GOVERNOR 控制，被限流時會等待後重試。
+    """
+    key = f"cr4/product/{pid}"
+    headers = fingerprints.validators(key) if fingerprints is not None else {}
+    url = f"https://online.carrefour.com.tw/zh/{pid}.html"
+    telemetry = telemetry if telemetry is not None else Telemetry(None)
 
-async def cr4_get_product_price(pid):
-    async with aiohttp.request("get", f"https://online.carrefour.com.tw/zh/{pid}.html") as resp:
+    with telemetry.request("cr4/product", category, key=pid) as event:
+        for attempt in range(GOVERNOR.max_retries + 1):
+            event.retries = attempt
+            start = time.perf_counter()
+            slot = await GOVERNOR.aslot(url)
+            event.wait += time.perf_counter() - start
+            async with slot:
+                async with aiohttp.request(
+                    "get", url, headers=headers, timeout=aiohttp.ClientTimeout(total=TIMEOUT)
+                ) as resp:
+                    slot.record(resp.status, resp.headers)
+                    body = await resp.read()
+                    text = await resp.text()
+            if not slot.throttled:
+                break
+        event.response(resp.status, len(body))
+
+        if resp.status == 304:
+            fingerprints.not_modified(key)
+            return None
         resp.raise_for_status()
-        soup = BeautifulSoup(await resp.text(), "lxml")
+        soup = BeautifulSoup(text, "lxml")
+
+        price = soup.select_one("#product-details-form span.money").text
 
-    price = soup.select_one("#product-details-form span.money").text
+        if not price or not price.isdigit():
+            raise ValueError("Price not found")
+        event.items = 1
 
-    if not price or not price.isdigit():
-        raise ValueError("Price not found")
+    if fingerprints is not None:
+        fingerprints.remember_validators(key, resp.headers)
+        if not fingerprints.check(key, price):
+            return None
 
     return int(price)
 
 
-async def cr4_update():
+async def cr4_fetch_prices(
+    products,
+    fingerprints: FingerprintStore = None,
+    progress: bool = True,
+    telemetry: Telemetry = None,
+    concurrency: int = MAX_CONCURRENT_REQUESTS,
+):
+    """
+    同時取得家樂福商品頁的價格，回傳 ({product_id: price}, 失敗的 pid)。
+    沒有變動的商品不會出現在結果中。
+    最多 `concurrency` 個商品同時處理，實際同時送出的請求數由 GOVERNOR 依回應狀況調整。
+    """
+    errors = []
+    prices = {}
+    products = list(products)
+    queue = iter(products)
+
+    async def worker(pbar):
+        for product in queue:
+            try:
+                price = await cr4_get_product_price(product.pid, fingerprints, telemetry, product.category_id)
+                if price is not None:
+                    prices[product.id] = price
+            except Exception:
+                errors.append(product.pid)
+            pbar.update(1)
+
+    with tqdm(total=len(products), desc="Carrefour", disable=not progress) as pbar:
+        await asyncio.gather(*(worker(pbar) for _ in range(max(1, min(concurrency, len(products))))))
+
+    return prices, errors
+
+
+def apply_cr4_prices(session, generation_id: int, prices):
+    """
+    寫入家樂福商品的價格 ({product_id: price})，並記錄價格歷史與商品異動。不會 commit。
+    """
+    ids = list(prices)
+    before = product_state(session, ids=ids)
+    for product in session.query(Product).filter(Product.id.in_(ids)):
+        price = prices[product.id]
+        product.price = price
+        product.price_unit = round(price / product.spec, 4)
+
+    record_prices(session, prices)
+    record_changes(session, generation_id, before, ids=ids)
+
+
+async def cr4_update(generation_id: int, defer: bool = False):
     session = create_session()
-    products = session.query(Product).filter(Product.channel == "家樂福")
+    products = session.query(Product).filter(Product.channel_id == Channel.id_of("家樂福"))
 
-    errors = []
+    fingerprints = FingerprintStore("cr4")
+    products, _ = fingerprints.prioritize(products.all(), key=lambda p: f"cr4/product/{p.pid}", defer=defer)
+
+    telemetry = Telemetry("cr4")
+    prices, errors = await cr4_fetch_prices(products, fingerprints, telemetry=telemetry)
+    telemetry.close()
+    if errors:
+        # 各商品失敗的原因見 telemetry 的 JSONL (key 為 pid)
+        print(f"{len(errors)} products failed, see {telemetry.path}")
+
+    apply_cr4_prices(session, generation_id, prices)
+    session.commit()
+    session.close()
+
+    fingerprints.save()
+    print(fingerprints.summary())
 
-    async for product in tqdm_asyncio(products.all(), desc="Carrefour"):
-        try:
-            pid = product.pid
-            price = await cr4_get_product_price(pid)
-            product.price = price
-            product.price_unit = round(price / product.spec, 4)
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            errors.append(pid)
-            continue
-
-    print("Errors:")
-    print(errors)
 
+def normalize_update(generation_id: int):
+    """
+    價格更新後統一換算規格並重新計算所有商品的 price_unit。
+    """
+    session = create_session()
+    count = normalize_products(session, generation_id)
     session.commit()
     session.close()
+    print(f"Normalized {count} products")
 
 
 def to_csv():
@@ -76,12 +262,9 @@ def to_csv():
     products = session.query(Product).all()
 
     with open("products.csv", "w", encoding="utf-8", newline="") as f:
-        fieldnames = Product.__table__.columns.keys()
-        writer = csv.writer(f)
-        writer.writerow(fieldnames)
-
-        for product in products:
-            writer.writerow([getattr(product, c) for c in fieldnames])
+        writer = csv.DictWriter(f, fieldnames=PRODUCT_FIELDS)
+        writer.writeheader()
+        writer.writerows(product.to_dict() for product in products)
 
     session.close()
 
@@ -91,19 +274,36 @@ def from_csv():
         reader = csv.DictReader(f)
         products = [row for row in reader]
 
+    normalize_rows(products)
+
+    generation_id = begin_generation()
     session = create_session()
-    for product in products:
-        p = Product(**product)
-        session.add(p)
-    session.commit()
-    session.close()
+    try:
+        before = product_state(session)
+        for product in products:
+            p = Product.from_dict(session, product)
+            session.add(p)
+        record_changes(session, generation_id, before)
+        session.commit()
+    finally:
+        session.close()
+        finish_generation(generation_id)
 
 
 if __name__ == "__main__":
     # drop_table()
-    # create_table()
-    px_update()
-    asyncio.run(cr4_update())
+    create_table()
+    # 上次被強制結束 (例如 SIGKILL) 而沒有結束的批次
+    close_abandoned_generations()
+    generation_id = begin_generation()
+    try:
+        px_update(generation_id)
+        asyncio.run(cr4_update(generation_id))
+        normalize_update(generation_id)
+    finally:
+        # 沒有完成的批次會擋住之後所有批次的異動同步，中途失敗時已寫入的異動也要能同步
+        finish_generation(generation_id)
+    build_snapshot()
 
     # to_csv()
     # from_csv()
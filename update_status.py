@@ -0,0 +1,75 @@
+"""
+排程更新 (scheduler.py) 的進度查詢
+
+只用到 update_runs / work_units 兩個資料表，API 不需要載入爬蟲。
+"""
+
+from collections import Counter
+from datetime import timedelta
+from typing import List
+
+from sqlalchemy import func
+
+from database import UpdateRun, WorkUnit
+
+# 各通路商多久更新一次
+INTERVALS = {
+    "px": timedelta(hours=24),
+    "cr4": timedelta(hours=24),
+}
+
+
+def work_unit_counts(session, run_id: int) -> Counter:
+    """
+    一次更新中各狀態的工作單位數量。
+    """
+    return Counter(
+        dict(
+            session.query(WorkUnit.status, func.count())
+            .filter(WorkUnit.run_id == run_id)
+            .group_by(WorkUnit.status)
+            .all()
+        )
+    )
+
+
+def update_status(session) -> List[dict]:
+    """
+    各通路商最近一次更新的進度。
+    """
+    status = []
+    for channel in INTERVALS:
+        run = session.query(UpdateRun).filter(UpdateRun.channel == channel).order_by(UpdateRun.id.desc()).first()
+        if run is None:
+            continue
+        counts = work_unit_counts(session, run.id)
+        items, failed_items = (
+            session.query(func.sum(WorkUnit.items), func.sum(WorkUnit.failed_items))
+            .filter(WorkUnit.run_id == run.id)
+            .one()
+        )
+        last_error = (
+            session.query(WorkUnit.error)
+            .filter(WorkUnit.run_id == run.id, WorkUnit.error.isnot(None))
+            .order_by(WorkUnit.updated_at.desc())
+            .limit(1)
+            .scalar()
+        )
+        status.append(
+            {
+                "channel": channel,
+                "run_id": run.id,
+                "generation": run.generation_id,
+                "status": run.status,
+                "started_at": run.started_at,
+                "finished_at": run.finished_at,
+                "next_run_at": run.started_at + INTERVALS[channel],
+                "pending": counts["pending"],
+                "done": counts["done"],
+                "failed": counts["failed"],
+                "items": items or 0,
+                "failed_items": failed_items or 0,
+                "last_error": last_error,
+            }
+        )
+    return status